@@ -1,15 +1,249 @@
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import gzip
+import hashlib
 import html
+import ipaddress
 import json
 import os
+import queue
+import re
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import urllib.error
 import urllib.request
 from urllib.parse import urlparse
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 OPTIONS_PATH = "/data/options.json"
 BACKUP_PATH = "/share/webui-proxy.json"
 NGINX_CONF_PATH = "/etc/nginx/nginx.conf"
+SNIPPET_DIR = "/etc/nginx/webui-proxy"
 HTML_PATH = "/app/html/index.html"
+BROTLI_MODULE_PATH = "/usr/lib/nginx/modules/ngx_http_brotli_static_module.so"
+HTTP2_MIN_VERSION = (1, 25, 1)
+NGINX_PID_PATH = "/run/nginx/nginx.pid"
+ERROR_LOG_PATH = "/var/log/nginx/error.log"
+LISTEN_PORT = 8080
+RESOLV_CONF_PATH = "/etc/resolv.conf"
+DNS_CONCURRENCY = 16
+LOCK_PATH = "/run/nginx/webui-proxy.lock"
+STATUS_PATH = "/dev/shm/webui-proxy/status.json"
+FAST_FAIL_CONNECT_TIMEOUT = 2
+ACCESS_LOG_PATH = "/dev/shm/webui-proxy/access.log"
+METRICS_PORT = 9145
+WATCH_INTERVAL = 5
+SUPERVISOR_TIMEOUT = 10
+SUPERVISOR_RETRIES = 6
+SUPERVISOR_MAX_BACKOFF = 30
+CACHE_PATH = "/data/cache"
+REWRITE_PORT = 8081
+REWRITER_PORT = 8082
+REWRITER_CACHE_PATH = "/data/rewriter-cache"
+ROUTE_COOKIE = "webui_proxy_target"
+PROXY_BASE = "$http_x_ingress_path/proxy/$proxy_index"
 HTTPS_PORTS = {443, 8443, 8006}
+PASSTHROUGH_EXTENSIONS = (
+    "png|jpe?g|gif|webp|avif|ico|bmp|woff2?|ttf|eot|otf|wasm|json|map"
+    "|mp3|mp4|m4a|webm|ogg|wav|flac|mkv|mov|avi|m3u8|ts|mjpe?g"
+    "|zip|gz|tgz|tar|xz|bz2|7z|bin|img|iso|pdf"
+)
+TARGET_DEFAULTS = {
+    "compress": True,
+    "rules": "",
+    "profile": "web",
+    "passthrough": "",
+    "rate_limit": 100,
+    "conn_limit": 128,
+    "max_conns": 0,
+    "engine": "nginx",
+}
+# nginx rewrites with sub_filter; python hands page, script and stylesheet
+# responses to rewriter.py, which parses HTML attributes, CSS and JS imports.
+ENGINES = ("nginx", "python")
+PROFILES = {
+    # WebSockets, event streams and long polls: pass bytes through as they
+    # arrive and keep idle connections open.
+    "realtime": {
+        "buffering": "off",
+        "request_buffering": "off",
+        "buffer_size": "8k",
+        "buffers": None,
+        "busy_buffers_size": None,
+        "timeout": 3600,
+    },
+    # Pages and bundles: read the response quickly so the device connection is
+    # released, and let nginx feed slow clients from its buffers.
+    "web": {
+        "buffering": "on",
+        "request_buffering": "on",
+        "buffer_size": "16k",
+        "buffers": "32 16k",
+        "busy_buffers_size": "64k",
+        "timeout": 300,
+    },
+    # Downloads, firmware and backups: large buffers, uploads streamed to the
+    # device as they arrive.
+    "bulk": {
+        "buffering": "on",
+        "request_buffering": "off",
+        "buffer_size": "64k",
+        "buffers": "16 64k",
+        "busy_buffers_size": "256k",
+        "timeout": 900,
+    },
+}
+# Downloads, snapshots and media: nothing to rewrite, so the device's own
+# encoding is kept and large bodies stream through memory buffers instead of
+# being spooled to disk.
+PASSTHROUGH_PROFILE = {
+    "buffering": "on",
+    "request_buffering": "off",
+    "buffer_size": "16k",
+    "buffers": "16 64k",
+    "busy_buffers_size": "128k",
+    "max_temp_file_size": "0",
+    "timeout": 3600,
+}
+# Path classes under a target prefix and the profile each one uses for a given
+# target profile; page paths use the target profile itself.
+PATH_CLASSES = {"api": "(?:api|rpc)/", "ws": "(?:ws|websocket|socket\\.io)/"}
+PATH_PROFILES = {
+    "realtime": {"api": "realtime", "ws": "realtime"},
+    "web": {"api": "realtime", "ws": "realtime"},
+    "bulk": {"api": "web", "ws": "realtime"},
+}
+BOOTSTRAP_JS = (
+    "(function(){"
+    'var s=document.currentScript,base=s.getAttribute("data-base"),haBase=s.getAttribute("data-ha");'
+    "window.__ingress_base=base;"
+    "try{if(!window.url){window.url=function(){return new URL(...arguments);};}"
+    "if(window.URL){window.url.prototype=window.URL.prototype;window.url.URL=window.URL;}}catch(e){}"
+    "function fix(u){try{if(!u)return u;if(typeof u===\"string\"){if(u.indexOf(base)===0)return u;"
+    'if(u[0]==="/")return base+u.slice(1);'
+    "var m=u.match(/^(https?:\\/\\/|wss?:\\/\\/)([^/]+)\\/(.*)/);"
+    "if(m&&m[2]===location.host){return m[1]+m[2]+base+m[3];}}return u;}catch(e){return u;}}"
+    "var _f=window.fetch;if(_f){window.fetch=function(input,init){return _f.call(this,fix(input),init);};}"
+    "var _o=XMLHttpRequest.prototype.open;XMLHttpRequest.prototype.open=function(method,url){"
+    "return _o.apply(this,[method,fix(url)].concat([].slice.call(arguments,2)));};"
+    "var _ws=window.WebSocket;if(_ws){window.WebSocket=function(url,protocols){"
+    "return protocols!==undefined?new _ws(fix(url),protocols):new _ws(fix(url));};"
+    "window.WebSocket.prototype=_ws.prototype;}"
+    "try{var _set=Element.prototype.setAttribute;Element.prototype.setAttribute=function(name,value){"
+    'if(name==="src"||name==="href"){return _set.call(this,name,fix(value));}'
+    "return _set.call(this,name,value);};"
+    'var sd=Object.getOwnPropertyDescriptor(HTMLScriptElement.prototype,"src");'
+    'if(sd&&sd.set){Object.defineProperty(HTMLScriptElement.prototype,"src",'
+    "{set:function(v){return sd.set.call(this,fix(v));},get:sd.get});}"
+    'var ld=Object.getOwnPropertyDescriptor(HTMLLinkElement.prototype,"href");'
+    'if(ld&&ld.set){Object.defineProperty(HTMLLinkElement.prototype,"href",'
+    "{set:function(v){return ld.set.call(this,fix(v));},get:ld.get});}}catch(e){}"
+    # The back button only needs to survive body/html children being replaced,
+    # so observe those two nodes directly instead of the whole subtree.
+    "var btn,watched;function ensureBack(){try{var b=document.body;if(!b)return;"
+    "if(watched!==b){watched=b;new MutationObserver(ensureBack).observe(b,{childList:true});}"
+    "if(btn&&btn.parentNode===b)return;"
+    'if(!btn){btn=document.createElement("a");btn.id="ha-back-btn";btn.href=haBase;'
+    'btn.textContent="\\u2190 \\u0412 HA";'
+    'btn.setAttribute("style","position:fixed;top:12px;left:12px;z-index:2147483647;'
+    "background:#111827;color:#fff;padding:8px 12px;border-radius:8px;text-decoration:none;"
+    'font-family:Arial,sans-serif;font-size:13px;box-shadow:0 6px 16px rgba(0,0,0,.2)");}'
+    "b.appendChild(btn);}catch(e){}}"
+    'if(document.readyState==="loading"){document.addEventListener("DOMContentLoaded",ensureBack);}'
+    "else{ensureBack();}"
+    "try{new MutationObserver(ensureBack).observe(document.documentElement,{childList:true});}catch(e){}"
+    "})();"
+)
+REWRITE_PACKS = ("core", "webpack", "fonts", "api")
+REWRITE_TYPES = {
+    "html": (
+        "text/html",
+        "text/css",
+        "application/javascript",
+        "text/javascript",
+        "application/x-javascript",
+    ),
+    "js": ("application/javascript", "text/javascript", "application/x-javascript"),
+    "css": ("text/css",),
+}
+REWRITE_EXTENSIONS = {"js": r"\.m?js$", "css": r"\.css$"}
+REWRITE_RULES = [
+    ("core", "html js", 'href="/', 'href="{base}/'),
+    ("core", "html js", 'src="/', 'src="{base}/'),
+    ("core", "html js", 'action="/', 'action="{base}/'),
+    ("core", "html js", "href=/", "href={base}/"),
+    ("core", "html js", "src=/", "src={base}/"),
+    ("core", "html js", "action=/", "action={base}/"),
+    ("core", "html js", "href='/", "href='{base}/"),
+    ("core", "html js", "src='/", "src='{base}/"),
+    ("core", "html js", "action='/", "action='{base}/"),
+    ("core", "html css js", 'url("/', 'url("{base}/'),
+    ("core", "html css js", "url('/", "url('{base}/"),
+    ("core", "html css js", "url(/", "url({base}/"),
+    ("fonts", "css", "url(glyphicons-", "url({base}/glyphicons-"),
+    ("fonts", "css", 'url("glyphicons-', 'url("{base}/glyphicons-'),
+    ("fonts", "css", "url('glyphicons-", "url('{base}/glyphicons-"),
+    ("fonts", "css", "url(fontawesome-", "url({base}/fontawesome-"),
+    ("fonts", "css", 'url("fontawesome-', 'url("{base}/fontawesome-'),
+    ("fonts", "css", "url('fontawesome-", "url('{base}/fontawesome-"),
+    ("api", "html js", '"/api/', '"{base}/api/'),
+    ("api", "html js", "'/api/", "'{base}/api/"),
+    ("api", "html js", '"/rpc/', '"{base}/rpc/'),
+    ("api", "html js", "'/rpc/", "'{base}/rpc/"),
+    ("api", "html js", '"/ws/', '"{base}/ws/'),
+    ("api", "html js", "'/ws/", "'{base}/ws/"),
+    ("api", "html js", '"/scripts/', '"{base}/scripts/'),
+    ("api", "html js", "'/scripts/", "'{base}/scripts/"),
+    ("fonts", "html css js", '"/glyphicons-', '"{base}/glyphicons-'),
+    ("fonts", "html css js", "'/glyphicons-", "'{base}/glyphicons-"),
+    ("core", "html css js", "http://{hostport}/", "{base}/"),
+    ("core", "html css js", "https://{hostport}/", "{base}/"),
+    ("core", "html css js", "//{hostport}/", "{base}/"),
+    ("core", "html css js", "http://{host}/", "{base}/"),
+    ("core", "html css js", "https://{host}/", "{base}/"),
+    ("core", "html css js", "//{host}/", "{base}/"),
+    ("webpack", "html js", 'o.p="/', 'o.p="{base}/'),
+    ("webpack", "html js", "o.p='/", "o.p='{base}/"),
+    ("webpack", "html js", '__webpack_require__.p="/', '__webpack_require__.p="{base}/'),
+    ("webpack", "html js", "__webpack_require__.p='/", "__webpack_require__.p='{base}/"),
+    ("webpack", "html js", 'publicPath:"/', 'publicPath:"{base}/'),
+    ("webpack", "html js", "publicPath:'/", "publicPath:'{base}/"),
+]
+DEFAULT_SETTINGS = {
+    "upstream_keepalive": 16,
+    "upstream_keepalive_timeout": 60,
+    "cache_size": 128,
+    "worker_processes": 0,
+    "worker_connections": 0,
+    "max_open_files": 0,
+    "health_interval": 30,
+    "health_timeout": 3,
+    "health_concurrency": 8,
+    "health_http": False,
+    "metrics": True,
+    "dns_timeout": 3,
+    "dns_valid": 30,
+    "skip_unresolved": False,
+    "keepalive_timeout": 65,
+    "keepalive_requests": 1000,
+    "header_buffer_size": 4,
+    "large_header_buffer_size": 32,
+    "http2": False,
+}
 DEFAULT_TARGETS = [
     {"name": "Мое устройство", "url": "192.168.1.10"},
     "192.168.1.10",
@@ -23,16 +257,99 @@ def _load_json(path):
         return json.load(file)
 
 
+def _file_digest(path):
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).digest()
+    except OSError:
+        return None
+
+
+def _write_bytes(path, data):
+    if _file_digest(path) == hashlib.sha256(data).digest():
+        return False
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}."
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+
+def _write_text(path, content):
+    return _write_bytes(path, content.encode("utf-8"))
+
+
+def _brotli_enabled():
+    return brotli is not None and os.path.exists(BROTLI_MODULE_PATH)
+
+
+def _nginx_version():
+    try:
+        result = subprocess.run(["nginx", "-v"], capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r"nginx/(\d+)\.(\d+)\.(\d+)", result.stderr + result.stdout)
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def _write_static(path, content):
+    # Precompressed copies for gzip_static/brotli_static, written before the
+    # original so nginx never pairs a new file with an old .gz. mtime=0 keeps
+    # the archive identical for identical content, so unchanged files are
+    # skipped.
+    data = content.encode("utf-8")
+    changed = _write_bytes(f"{path}.gz", gzip.compress(data, 9, mtime=0))
+    if _brotli_enabled():
+        changed = _write_bytes(f"{path}.br", brotli.compress(data, quality=11)) or changed
+    elif os.path.exists(f"{path}.br"):
+        os.remove(f"{path}.br")
+    return _write_bytes(path, data) or changed
+
+
 def _write_json(path, payload):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as file:
-        json.dump(payload, file, ensure_ascii=False, indent=2)
+    return _write_text(path, json.dumps(payload, ensure_ascii=False, indent=2))
+
+
+def _coerce_setting(value, default):
+    if isinstance(default, bool):
+        return bool(value)
+    if isinstance(default, int):
+        return max(0, int(value))
+    return str(value).strip()
 
 
 def _parse_target(raw):
+    options = dict(TARGET_DEFAULTS)
     if isinstance(raw, dict):
         name = raw.get("name", "").strip()
         url = raw.get("url", "").strip()
+        for key, default in TARGET_DEFAULTS.items():
+            if raw.get(key) is not None:
+                try:
+                    options[key] = _coerce_setting(raw[key], default)
+                except (TypeError, ValueError):
+                    pass
+        if options["profile"] not in PROFILES:
+            options["profile"] = TARGET_DEFAULTS["profile"]
+        if options["engine"] not in ENGINES:
+            options["engine"] = TARGET_DEFAULTS["engine"]
     else:
         name = ""
         url = (raw or "").strip()
@@ -75,9 +392,22 @@ def _parse_target(raw):
         "scheme": scheme,
         "host": host,
         "port": port,
+        **options,
     }
 
 
+def _target_key(target):
+    return f"{target['host']}:{target['port']}"
+
+
+def _target_payload(target):
+    payload = {"name": target.get("name", ""), "url": target.get("raw", "")}
+    for key, default in TARGET_DEFAULTS.items():
+        if target.get(key, default) != default:
+            payload[key] = target[key]
+    return payload
+
+
 def _is_default_targets(targets):
     if not targets:
         return False
@@ -107,17 +437,30 @@ def _load_targets():
     return parsed_targets, restored
 
 
+def _load_settings():
+    data = _load_json(OPTIONS_PATH) or {}
+    settings = dict(DEFAULT_SETTINGS)
+    for key, default in DEFAULT_SETTINGS.items():
+        value = data.get(key)
+        if value is None:
+            continue
+        try:
+            settings[key] = _coerce_setting(value, default)
+        except (TypeError, ValueError):
+            settings[key] = default
+    return settings
+
+
 def _update_supervisor_options(targets):
+    # True when the options were sent, False when worth retrying, None when
+    # there is nothing to send to or the Supervisor refused them.
     token = os.getenv("SUPERVISOR_TOKEN")
     if not token:
-        return
+        return None
     base_url = os.getenv("SUPERVISOR_URL", "http://supervisor")
     payload = {
         "options": {
-            "targets": [
-                {"name": target.get("name", ""), "url": target.get("raw", "")}
-                for target in targets
-            ]
+            "targets": [_target_payload(target) for target in targets]
         }
     }
     try:
@@ -130,25 +473,55 @@ def _update_supervisor_options(targets):
             },
             method="POST",
         )
-        with urllib.request.urlopen(req, timeout=10):
+        with urllib.request.urlopen(req, timeout=SUPERVISOR_TIMEOUT):
             pass
-    except (urllib.error.URLError, urllib.error.HTTPError, ValueError):
-        return
+    except urllib.error.HTTPError as err:
+        # Client errors will not fix themselves; anything else is worth a retry.
+        if 400 <= err.code < 500 and err.code != 429:
+            _log(f"supervisor rejected options: HTTP {err.code}")
+            return None
+        return False
+    except (urllib.error.URLError, OSError, ValueError):
+        return False
+    return True
+
+
+def _sync_supervisor_options(targets):
+    delay = 1
+    for attempt in range(1, SUPERVISOR_RETRIES + 1):
+        started = time.monotonic()
+        result = _update_supervisor_options(targets)
+        if result is None:
+            if not os.getenv("SUPERVISOR_TOKEN"):
+                _log("SUPERVISOR_TOKEN is not set, skipped syncing restored targets")
+            return False
+        if result:
+            _log(
+                f"synced {len(targets)} restored target(s) to supervisor "
+                f"in {(time.monotonic() - started) * 1000:.0f} ms (attempt {attempt})"
+            )
+            return True
+        if attempt < SUPERVISOR_RETRIES:
+            time.sleep(delay)
+            delay = min(delay * 2, SUPERVISOR_MAX_BACKOFF)
+    _log(f"giving up syncing options to supervisor after {SUPERVISOR_RETRIES} attempts")
+    return False
+
+
+def _spawn_supervisor_sync():
+    # Detached so that nginx can start while the Supervisor is slow to answer.
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--sync-options"],
+        stdin=subprocess.DEVNULL,
+        start_new_session=True,
+    )
 
 
 def _write_backup(targets):
     if not targets:
-        return
-    payload = {
-        "targets": [
-            {
-                "name": target.get("name", ""),
-                "url": target.get("raw", ""),
-            }
-            for target in targets
-        ]
-    }
-    _write_json(BACKUP_PATH, payload)
+        return False
+    payload = {"targets": [_target_payload(target) for target in targets]}
+    return _write_json(BACKUP_PATH, payload)
 
 
 def _render_index(targets):
@@ -160,14 +533,16 @@ def _render_index(targets):
                         label = target.get("name", f"{target['host']}:{target['port']}")
                         items.append(
                                 """
-                                <li class="card">
+                                <li class="card" data-target="{key}">
                                     <a class="card-link" href="proxy/{idx}/">
                                         <span class="card-title">{label}</span>
                                         <span class="card-sub">{raw}</span>
+                                        <span class="card-status"></span>
                                     </a>
                                 </li>
                                 """.format(
                                         idx=idx,
+                                        key=html.escape(_target_key(target)),
                                         label=html.escape(label),
                                         raw=html.escape(target.get("raw", "")),
                                 )
@@ -262,6 +637,19 @@ def _render_index(targets):
             .card-title {{ font-weight: 600; }}
             .card-sub {{ font-size: 12px; color: var(--muted); word-break: break-all; }}
             .empty {{ color: var(--muted); }}
+            .card-status {{ font-size: 12px; color: var(--muted); }}
+            .card-status:empty {{ display: none; }}
+            .card-status::before {{
+                content: "";
+                display: inline-block;
+                width: 8px;
+                height: 8px;
+                margin-right: 6px;
+                border-radius: 50%;
+                background: var(--muted);
+            }}
+            .card.up .card-status::before {{ background: #22c55e; }}
+            .card.down .card-status::before {{ background: #ef4444; }}
         </style>
     </head>
     <body>
@@ -272,121 +660,707 @@ def _render_index(targets):
         <main>
             {body}
         </main>
+        <script>
+            (function () {{
+                function refresh() {{
+                    fetch("status.json", {{ cache: "no-store" }})
+                        .then(function (response) {{ return response.ok ? response.json() : null; }})
+                        .then(function (data) {{
+                            if (!data) return;
+                            document.querySelectorAll(".card[data-target]").forEach(function (card) {{
+                                var item = data.targets[card.dataset.target];
+                                if (!item) return;
+                                card.classList.toggle("up", item.up);
+                                card.classList.toggle("down", !item.up);
+                                card.querySelector(".card-status").textContent =
+                                    item.up ? item.latency_ms + " мс" : "недоступно";
+                            }});
+                        }})
+                        .catch(function () {{}});
+                }}
+                refresh();
+                setInterval(refresh, 10000);
+            }})();
+        </script>
     </body>
 </html>"""
 
 
-def _render_nginx_conf(targets):
-    locations = []
-    default_target = ""
-    default_host = ""
-    if len(targets) == 1:
-        only = targets[0]
-        default_target = f"{only['scheme']}://{only['host']}:{only['port']}"
-        default_host = f"{only['host']}:{only['port']}"
-
-    referer_map = [
-        "    map $http_referer $proxy_target {",
-        f"        default \"{default_target}\";",
-    ]
-    referer_host_map = [
-        "    map $http_referer $proxy_host {",
-        f"        default \"{default_host}\";",
+def _upstream_name(idx):
+    return f"target_{idx}"
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _resolve_hosts(hosts, timeout):
+    # Daemon workers rather than a ThreadPoolExecutor: getaddrinfo cannot be
+    # cancelled, and the executor would keep the process alive until a stuck
+    # mDNS lookup gives up on its own.
+    pending = queue.Queue()
+    for host in hosts:
+        pending.put(host)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                host = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[host] = bool(socket.getaddrinfo(host, None, type=socket.SOCK_STREAM))
+            except (OSError, UnicodeError):
+                results[host] = False
+
+    workers = [
+        threading.Thread(target=worker, daemon=True)
+        for _ in range(min(DNS_CONCURRENCY, len(hosts)))
     ]
+    for thread in workers:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in workers:
+        thread.join(max(0, deadline - time.monotonic()))
+    return {host: results.get(host, False) for host in hosts}
+
+
+def _check_targets(targets, settings):
+    hosts = sorted({target["host"] for target in targets if not _is_ip(target["host"])})
+    if not hosts:
+        return targets
+    started = time.monotonic()
+    resolved = _resolve_hosts(hosts, settings["dns_timeout"] or 3)
+    failed = {host for host in hosts if not resolved[host]}
+    _log(
+        f"resolved {len(hosts) - len(failed)}/{len(hosts)} hostname(s) "
+        f"in {(time.monotonic() - started) * 1000:.0f} ms"
+    )
+    for host in sorted(failed):
+        if settings["skip_unresolved"]:
+            _log(f"cannot resolve {host}, not routing its targets")
+        else:
+            _log(f"cannot resolve {host}, nginx will retry when it is requested")
+    if not failed or not settings["skip_unresolved"]:
+        return targets
+    return [dict(target, skip=True) if target["host"] in failed else target for target in targets]
+
+
+def _nameservers():
+    servers = []
+    try:
+        with open(RESOLV_CONF_PATH, "r", encoding="utf-8") as file:
+            for line in file:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == "nameserver":
+                    servers.append(f"[{parts[1]}]" if ":" in parts[1] else parts[1])
+    except OSError:
+        pass
+    return servers
+
+
+def _render_resolver(targets, settings):
+    # Hostname targets are proxied through variables so that nginx resolves
+    # them per request (cached for dns_valid seconds) instead of once, blocking,
+    # at startup. Without a nameserver they fall back to upstream blocks.
+    if all(_is_ip(target["host"]) for target in targets):
+        return ""
+    servers = _nameservers()
+    if not servers:
+        return ""
+    return (
+        f"    resolver {' '.join(servers)} valid={settings['dns_valid'] or 30}s;\n"
+        f"    resolver_timeout {settings['dns_timeout'] or 3}s;\n\n"
+    )
+
+
+def _render_upstreams(targets, settings, dynamic=False):
+    blocks = []
     for idx, target in enumerate(targets, start=1):
-        referer_map.append(
-            f"        ~*/proxy/{idx}/ {target['scheme']}://{target['host']}:{target['port']};"
-        )
-        referer_host_map.append(
-            f"        ~*/proxy/{idx}/ {target['host']}:{target['port']};"
+        if target.get("skip") or (dynamic and not _is_ip(target["host"])):
+            continue
+        server = f"{target['host']}:{target['port']}"
+        if target["max_conns"]:
+            server += f" max_conns={target['max_conns']}"
+        lines = [
+            f"    upstream {_upstream_name(idx)} {{",
+            f"        server {server};",
+        ]
+        if target["max_conns"]:
+            # Without a shared zone each worker counts max_conns on its own.
+            lines.append(f"        zone {_upstream_name(idx)} 64k;")
+        if settings["upstream_keepalive"]:
+            lines += [
+                f"        keepalive {settings['upstream_keepalive']};",
+                f"        keepalive_timeout {settings['upstream_keepalive_timeout']}s;",
+                "        keepalive_requests 1000;",
+            ]
+        lines.append("    }")
+        blocks.append("\n".join(lines))
+    if any(target["engine"] == "python" and not target.get("skip") for target in targets):
+        blocks.append(
+            "    upstream rewriter_loopback {\n"
+            f"        server 127.0.0.1:{REWRITER_PORT};\n"
+            f"        keepalive {settings['upstream_keepalive'] or 16};\n"
+            "    }"
         )
-    referer_map.append("    }")
-    referer_host_map.append("    }")
-    referer_map_block = "\n".join(referer_map + [""] + referer_host_map)
+    return "\n\n".join(blocks)
+
+
+def _bootstrap_name():
+    digest = hashlib.sha256(BOOTSTRAP_JS.encode("utf-8")).hexdigest()
+    return f"webui-proxy.{digest[:12]}.js"
+
+
+def _head_injection():
+    return (
+        f'<head><base href="{PROXY_BASE}/">'
+        f'<script src="$http_x_ingress_path/{_bootstrap_name()}" '
+        f'data-base="{PROXY_BASE}/" data-ha="$http_x_ingress_path/"></script>'
+    )
+
+
+def _target_packs(target):
+    selected = {
+        pack.strip() for pack in target.get("rules", "").split(",") if pack.strip()
+    }
+    if not selected:
+        return set(REWRITE_PACKS)
+    return {"core"} | (selected & set(REWRITE_PACKS))
+
+
+def _rewrite_rules(target, kind=None):
+    # Per-target values come from the maps keyed by $proxy_index, so targets
+    # with the same rule packs share one set of sub_filter directives.
+    values = {"base": PROXY_BASE, "host": "$proxy_sni", "hostport": "$proxy_host"}
+    packs = _target_packs(target)
+    rules = []
+    for pack, kinds, search, replace in REWRITE_RULES:
+        if pack not in packs or (kind and kind not in kinds.split()):
+            continue
+        rules.append((search.format(**values), replace.format(**values)))
+    if kind in (None, "html"):
+        rules.append(("<head>", _head_injection()))
+    return rules
+
+
+def _quote(value):
+    if "'" in value:
+        return f'"{value}"'
+    return f"'{value}'"
+
+
+def _render_sub_filters(rules, indent="            "):
+    return f"\n{indent}".join(
+        f"sub_filter {_quote(search)} {_quote(replace)};" for search, replace in rules
+    ).lstrip()
+
+
+def _snippet(snippets, name, content):
+    # The content hash in the file name lets a new config be validated while
+    # the running one still includes the old snippets.
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    filename = f"{name}.{digest[:12]}.conf"
+    snippets[filename] = content
+    return f"include {SNIPPET_DIR}/{filename};"
+
+
+def _target_shapes(targets, down=()):
+    shapes = {}
     for idx, target in enumerate(targets, start=1):
-        proxy_pass = f"{target['scheme']}://{target['host']}:{target['port']}/"
-        prefix = f"/proxy/{idx}"
-        ssl_block = ""
-        if target["scheme"] == "https":
-            ssl_block = "\n            proxy_ssl_server_name on;\n            proxy_ssl_verify off;"
+        if target.get("skip"):
+            continue
+        key = (
+            tuple(sorted(_target_packs(target))),
+            target["compress"],
+            target["profile"],
+            target["engine"],
+            _target_key(target) in down,
+        )
+        shapes.setdefault(key, []).append(idx)
+    return shapes
+
+
+def _render_rewrite_location(pattern, kind, target, shape_block, upgrade=""):
+    return f"""
+location ~* "{pattern}" {{
+    sub_filter_types {" ".join(REWRITE_TYPES[kind])};
+    {_render_sub_filters(_rewrite_rules(target, kind), "    ")}{upgrade}
+    rewrite "^/proxy/\\d+/(.*)$" /$1 break;{shape_block}
+    proxy_pass $proxy_target;
+}}
+"""
+
+
+def _render_engine_location(pattern, shape_block, upgrade=""):
+    # rewriter.py decompresses, rewrites and recompresses itself, so it gets
+    # the client's Accept-Encoding and no gzip or sub_filter here.
+    return f"""
+location ~* "{pattern}" {{
+{_render_proxy_headers("$http_accept_encoding", "    ")}
+    proxy_set_header X-Webui-Proxy-Target $proxy_index;{upgrade}
+    rewrite "^/proxy/\\d+/(.*)$" /$1 break;{shape_block}
+    proxy_pass http://rewriter_loopback;
+}}
+"""
+
+
+def _render_proxy_headers(encoding, indent=""):
+    headers = (
+        ("Upgrade", "$http_upgrade"),
+        ("Connection", "$connection_upgrade"),
+        ("Host", "$proxy_host"),
+        ("X-Real-IP", "$remote_addr"),
+        ("X-Forwarded-For", "$proxy_add_x_forwarded_for"),
+        ("X-Forwarded-Proto", "$scheme"),
+        ("X-Forwarded-Prefix", PROXY_BASE),
+        ("Accept-Encoding", encoding),
+    )
+    return "\n".join(f"{indent}proxy_set_header {name} {value};" for name, value in headers)
+
+
+def _passthrough_paths(target):
+    paths = []
+    for path in target.get("passthrough", "").split(","):
+        path = path.strip().lstrip("/")
+        # Only plain path characters: the list ends up inside a quoted regex.
+        if path and re.fullmatch(r"[\w./~%+:@=-]+", path):
+            paths.append(re.escape(path))
+    return tuple(paths)
+
+
+def _render_passthrough_location(pattern):
+    return f"""location ~* "{pattern}" {{
+{_render_proxy_headers("$proxy_passthrough_encoding", "    ")}
+    rewrite "^/proxy/\\d+/(.*)$" /$1 break;{_render_profile(PASSTHROUGH_PROFILE)}
+    proxy_pass $proxy_target;
+}}
+
+"""
+
+
+def _render_passthrough_locations(targets):
+    # Binary and media responses skip the rewrite locations: no sub_filter,
+    # no gzip, and the device's compression passes through untouched.
+    routed = [idx for idx, target in enumerate(targets, start=1) if not target.get("skip")]
+    if not routed:
+        return ""
+    groups = {}
+    for idx in routed:
+        paths = _passthrough_paths(targets[idx - 1])
+        if paths:
+            groups.setdefault(paths, []).append(idx)
+    locations = []
+    for paths, indices in groups.items():
+        ids = "|".join(str(idx) for idx in indices)
         locations.append(
-            f"""
-        location {prefix}/ {{
-            proxy_http_version 1.1;
-            proxy_set_header Upgrade $http_upgrade;
-            proxy_set_header Connection $connection_upgrade;
-            proxy_set_header Host {target['host']}:{target['port']};
-            proxy_set_header X-Real-IP $remote_addr;
-            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
-            proxy_set_header X-Forwarded-Proto $scheme;
-            proxy_set_header X-Forwarded-Prefix $http_x_ingress_path{prefix};
-            proxy_set_header Accept-Encoding "";
-            proxy_hide_header X-Frame-Options;
-            proxy_hide_header Content-Security-Policy;
-            proxy_hide_header X-Content-Security-Policy;
-            proxy_read_timeout 3600s;
-            proxy_send_timeout 3600s;
-            proxy_buffering off;
-            proxy_redirect ~^(https?://[^/]+)?(/.*)$ $http_x_ingress_path{prefix}$2;
-            proxy_cookie_path / $http_x_ingress_path{prefix}/;
-            sub_filter_once off;
-            sub_filter_types text/html text/css application/javascript text/javascript application/x-javascript;
-            sub_filter 'href="/' 'href="$http_x_ingress_path{prefix}/';
-            sub_filter 'src="/' 'src="$http_x_ingress_path{prefix}/';
-            sub_filter 'action="/' 'action="$http_x_ingress_path{prefix}/';
-            sub_filter 'href=/' 'href=$http_x_ingress_path{prefix}/';
-            sub_filter 'src=/' 'src=$http_x_ingress_path{prefix}/';
-            sub_filter 'action=/' 'action=$http_x_ingress_path{prefix}/';
-            sub_filter "href='/" "href='$http_x_ingress_path{prefix}/";
-            sub_filter "src='/" "src='$http_x_ingress_path{prefix}/";
-            sub_filter "action='/" "action='$http_x_ingress_path{prefix}/";
-            sub_filter 'url("/' 'url("$http_x_ingress_path{prefix}/';
-            sub_filter "url('/" "url('$http_x_ingress_path{prefix}/";
-            sub_filter 'url(/' 'url($http_x_ingress_path{prefix}/';
-            sub_filter 'url(glyphicons-' 'url($http_x_ingress_path{prefix}/glyphicons-';
-            sub_filter 'url("glyphicons-' 'url("$http_x_ingress_path{prefix}/glyphicons-';
-            sub_filter "url('glyphicons-" "url('$http_x_ingress_path{prefix}/glyphicons-";
-            sub_filter 'url(fontawesome-' 'url($http_x_ingress_path{prefix}/fontawesome-';
-            sub_filter 'url("fontawesome-' 'url("$http_x_ingress_path{prefix}/fontawesome-';
-            sub_filter "url('fontawesome-" "url('$http_x_ingress_path{prefix}/fontawesome-";
-            sub_filter '"/api/' '"$http_x_ingress_path{prefix}/api/';
-            sub_filter "'/api/" "'$http_x_ingress_path{prefix}/api/";
-            sub_filter '"/rpc/' '"$http_x_ingress_path{prefix}/rpc/';
-            sub_filter "'/rpc/" "'$http_x_ingress_path{prefix}/rpc/";
-            sub_filter '"/ws/' '"$http_x_ingress_path{prefix}/ws/';
-            sub_filter "'/ws/" "'$http_x_ingress_path{prefix}/ws/";
-            sub_filter '"/scripts/' '"$http_x_ingress_path{prefix}/scripts/';
-            sub_filter "'/scripts/" "'$http_x_ingress_path{prefix}/scripts/";
-            sub_filter '"/glyphicons-' '"$http_x_ingress_path{prefix}/glyphicons-';
-            sub_filter "'/glyphicons-" "'$http_x_ingress_path{prefix}/glyphicons-";
-            sub_filter 'http://{target['host']}:{target['port']}/' '$http_x_ingress_path{prefix}/';
-            sub_filter 'https://{target['host']}:{target['port']}/' '$http_x_ingress_path{prefix}/';
-            sub_filter '//{target['host']}:{target['port']}/' '$http_x_ingress_path{prefix}/';
-            sub_filter 'http://{target['host']}/' '$http_x_ingress_path{prefix}/';
-            sub_filter 'https://{target['host']}/' '$http_x_ingress_path{prefix}/';
-            sub_filter '//{target['host']}/' '$http_x_ingress_path{prefix}/';
-            sub_filter 'o.p="/' 'o.p="$http_x_ingress_path{prefix}/';
-            sub_filter "o.p='/" "o.p='$http_x_ingress_path{prefix}/";
-            sub_filter '__webpack_require__.p="/' '__webpack_require__.p="$http_x_ingress_path{prefix}/';
-            sub_filter "__webpack_require__.p='/" "__webpack_require__.p='$http_x_ingress_path{prefix}/";
-            sub_filter 'publicPath:"/' 'publicPath:"$http_x_ingress_path{prefix}/';
-            sub_filter "publicPath:'/" "publicPath:'$http_x_ingress_path{prefix}/";
-            sub_filter '<head>' '<head><base href="$http_x_ingress_path{prefix}/"><script>(function(){{var base="$http_x_ingress_path{prefix}/";var haBase="$http_x_ingress_path/";window.__ingress_base=base;try{{if(!window.url){{window.url=function(){{return new URL(...arguments);}};}}if(window.URL){{window.url.prototype=window.URL.prototype;window.url.URL=window.URL;}}}}catch(e){{}}function fix(u){{try{{if(!u)return u;if(typeof u==="string"){{if(u.indexOf(base)===0)return u;if(u[0]==="/")return base+u.slice(1);var m=u.match(/^(https?:\/\/|wss?:\/\/)([^/]+)\/(.*)/);if(m&&m[2]===location.host){{return m[1]+m[2]+base+m[3];}}}}return u;}}catch(e){{return u;}}}}var _f=window.fetch;if(_f){{window.fetch=function(input,init){{return _f.call(this,fix(input),init);}};}}var _o=XMLHttpRequest.prototype.open;XMLHttpRequest.prototype.open=function(method,url){{return _o.apply(this,[method,fix(url)].concat([].slice.call(arguments,2)));}};var _ws=window.WebSocket;if(_ws){{window.WebSocket=function(url,protocols){{return protocols!==undefined?new _ws(fix(url),protocols):new _ws(fix(url));}};window.WebSocket.prototype=_ws.prototype;}}try{{var _set=Element.prototype.setAttribute;Element.prototype.setAttribute=function(name,value){{if(name==="src"||name==="href"){{return _set.call(this,name,fix(value));}}return _set.call(this,name,value);}};var sd=Object.getOwnPropertyDescriptor(HTMLScriptElement.prototype,"src");if(sd&&sd.set){{Object.defineProperty(HTMLScriptElement.prototype,"src",{{set:function(v){{return sd.set.call(this,fix(v));}},get:sd.get}});}}var ld=Object.getOwnPropertyDescriptor(HTMLLinkElement.prototype,"href");if(ld&&ld.set){{Object.defineProperty(HTMLLinkElement.prototype,"href",{{set:function(v){{return ld.set.call(this,fix(v));}},get:ld.get}});}}}}catch(e){{}}function ensureBack(){{try{{if(document.getElementById("ha-back-btn"))return;var b=document.createElement("a");b.id="ha-back-btn";b.href=haBase;b.textContent="← В HA";b.setAttribute("style","position:fixed;top:12px;left:12px;z-index:2147483647;background:#111827;color:#fff;padding:8px 12px;border-radius:8px;text-decoration:none;font-family:Arial,sans-serif;font-size:13px;box-shadow:0 6px 16px rgba(0,0,0,.2)");document.body.appendChild(b);}}catch(e){{}}}}if(document.readyState==="loading"){{document.addEventListener("DOMContentLoaded",ensureBack);}}else{{ensureBack();}}try{{new MutationObserver(ensureBack).observe(document.documentElement,{{childList:true,subtree:true}});}}catch(e){{}}}})();</script>';
-            {ssl_block}
-            rewrite ^{prefix}/(.*)$ /$1 break;
-            proxy_pass {proxy_pass};
+            _render_passthrough_location(f"^/proxy/(?:{ids})/(?:{'|'.join(paths)})")
+        )
+    ids = "|".join(str(idx) for idx in routed)
+    locations.append(
+        _render_passthrough_location(f"^/proxy/(?:{ids})/.*\\.(?:{PASSTHROUGH_EXTENSIONS})$")
+    )
+    return "".join(locations)
+
+
+def _render_proxy_common():
+    return f"""proxy_http_version 1.1;
+{_render_proxy_headers("$proxy_upstream_encoding")}
+proxy_hide_header X-Frame-Options;
+proxy_hide_header Content-Security-Policy;
+proxy_hide_header X-Content-Security-Policy;
+proxy_redirect ~^(https?://[^/]+)?(/.*)$ {PROXY_BASE}$2;
+proxy_cookie_path / {PROXY_BASE}/;
+proxy_ssl_server_name on;
+proxy_ssl_name $proxy_sni;
+proxy_ssl_session_reuse on;
+proxy_ssl_verify off;
+add_header Set-Cookie $proxy_route_cookie;
+sub_filter_once off;
+sub_filter_last_modified on;
+"""
+
+
+def _render_profile(profile):
+    lines = [
+        f"proxy_buffering {profile['buffering']};",
+        f"proxy_request_buffering {profile['request_buffering']};",
+        f"proxy_buffer_size {profile['buffer_size']};",
+    ]
+    if profile["buffers"]:
+        lines += [
+            f"proxy_buffers {profile['buffers']};",
+            f"proxy_busy_buffers_size {profile['busy_buffers_size']};",
+        ]
+    if profile.get("max_temp_file_size"):
+        lines.append(f"proxy_max_temp_file_size {profile['max_temp_file_size']};")
+    lines += [
+        f"proxy_read_timeout {profile['timeout']}s;",
+        f"proxy_send_timeout {profile['timeout']}s;",
+    ]
+    return "".join(f"\n    {line}" for line in lines)
+
+
+def _render_proxy_shapes(targets, down=()):
+    # Targets that differ only in host, port, scheme or index render the same
+    # directives, so each group gets one js, css and html location matching
+    # its indices. Unknown indices fall through to the static 404.
+    shapes = []
+    for (_, compress, profile, engine, is_down), indices in _target_shapes(targets, down).items():
+        shape_block = ""
+        if compress:
+            shape_block += (
+                "\n    gzip on;"
+                "\n    gzip_proxied any;"
+                "\n    gzip_vary on;"
+                "\n    gzip_comp_level 5;"
+                "\n    gzip_min_length 1024;"
+                "\n    gzip_types text/css application/javascript text/javascript application/x-javascript;"
+            )
+        if is_down:
+            # The health checker saw these devices fail; do not hold a
+            # connection for the default 60s while the user waits.
+            shape_block += f"\n    proxy_connect_timeout {FAST_FAIL_CONNECT_TIMEOUT}s;"
+        ids = "|".join(str(idx) for idx in indices)
+        shapes.append(
+            (f"^/proxy/(?:{ids})/", targets[indices[0] - 1], shape_block, profile, engine)
+        )
+    locations = []
+    # API and WebSocket paths stay on nginx for both engines: they carry
+    # upgrades and long polls that gain nothing from the parser. For the
+    # python engine they need their own location even when their profile
+    # matches the page one, or the catch-all would send them to the rewriter.
+    for prefix, target, shape_block, profile, engine in shapes:
+        classes = {}
+        for path_class, class_profile in PATH_PROFILES[profile].items():
+            if class_profile != profile or engine == "python":
+                classes.setdefault(class_profile, []).append(PATH_CLASSES[path_class])
+        for class_profile, paths in classes.items():
+            pattern = f"{prefix}(?:{'|'.join(paths)})"
+            block = shape_block + _render_profile(PROFILES[class_profile])
+            locations.append(_render_rewrite_location(pattern, "html", target, block))
+    for kind in ("js", "css"):
+        for prefix, target, shape_block, profile, engine in shapes:
+            if engine == "python":
+                continue
+            pattern = f"{prefix}.*{REWRITE_EXTENSIONS[kind]}"
+            block = shape_block + _render_profile(PROFILES[profile])
+            locations.append(_render_rewrite_location(pattern, kind, target, block))
+    for prefix, target, shape_block, profile, engine in shapes:
+        upgrade = ""
+        if PROFILES[profile]["timeout"] < PROFILES["realtime"]["timeout"]:
+            # WebSockets on page paths (noVNC consoles, Node-RED's /comms)
+            # keep the realtime timeouts; the redirect runs before the rewrite.
+            upgrade = (
+                "\n    error_page 418 = @proxy_upgrade;"
+                '\n    if ($http_upgrade != "") { return 418; }'
+            )
+        if engine == "python":
+            # The rewriter picks the rules by response type, so one location
+            # covers pages, scripts and stylesheets.
+            block = _render_profile(PROFILES[profile])
+            locations.append(_render_engine_location(prefix, block, upgrade))
+            continue
+        block = shape_block + _render_profile(PROFILES[profile])
+        locations.append(_render_rewrite_location(prefix, "html", target, block, upgrade))
+    return _render_passthrough_locations(targets) + "".join(locations).lstrip()
+
+
+def _render_target_locations(targets, snippets, cached=False, down=()):
+    common = _snippet(snippets, "proxy-common", _render_proxy_common())
+    shapes = _snippet(snippets, "proxy-targets", _render_proxy_shapes(targets, down))
+    cache_location = _render_cache_location() if cached else ""
+    realtime = _render_profile(PROFILES["realtime"]).replace("\n    ", "\n            ")
+    return f"""location /proxy/ {{
+            {common}{cache_location}
+
+            {shapes}
         }}
-            """
+
+        location @proxy_upgrade {{
+            {common}
+            rewrite "^/proxy/\\d+/(.*)$" /$1 break;{realtime}
+            proxy_pass $proxy_target;
+        }}"""
+
+
+def _render_cache_tags(targets):
+    # The cache key names the device and the rewrite shape, not only the
+    # /proxy/N/ position: after a reload N may point to another device, or
+    # to the same one with other rule packs or engine.
+    lines = ["    map $proxy_index $proxy_cache_tag {", '        default "";']
+    for idx, target in enumerate(targets, start=1):
+        if target.get("skip"):
+            continue
+        shape = "|".join(
+            [target["scheme"], target["host"], str(target["port"]), target["engine"]]
+            + sorted(_target_packs(target))
         )
+        lines.append(f"        {idx} {hashlib.sha256(shape.encode('utf-8')).hexdigest()[:12]};")
+    lines.append("    }")
+    return "\n".join(lines)
+
+
+def _render_asset_cache(targets, settings):
+    if not settings["cache_size"]:
+        return ""
+    return f"""
+{_render_cache_tags(targets)}
+
+    proxy_cache_path {CACHE_PATH} levels=1:2 keys_zone=rewritten_assets:10m max_size={settings['cache_size']}m inactive=7d use_temp_path=off;
+
+    upstream rewrite_loopback {{
+        server 127.0.0.1:{REWRITE_PORT};
+        keepalive 8;
+    }}
+"""
+
 
-    return f"""worker_processes 1;
+def _render_cache_location():
+    return f"""
 
-pid /run/nginx/nginx.pid;
+            location ~ "^/proxy/\\d+/(?!(?:api|rpc|ws)/).*\\.(?:m?js|css)$" {{
+                proxy_cache rewritten_assets;
+                proxy_cache_key $http_x_ingress_path$proxy_cache_tag$request_uri;
+                proxy_cache_valid 200 10m;
+                proxy_cache_revalidate on;
+                proxy_cache_lock on;
+                proxy_cache_use_stale error timeout updating http_502 http_503 http_504;
+                proxy_cache_background_update on;
+                proxy_cache_bypass $http_authorization;
+                proxy_no_cache $http_authorization;
+                proxy_buffering on;
+                proxy_redirect off;
+                proxy_cookie_path off;
+                proxy_set_header Connection "";
+                proxy_set_header Accept-Encoding gzip;
+                gunzip on;
+                add_header X-Cache-Status $upstream_cache_status always;
+                proxy_pass http://rewrite_loopback;
+            }}"""
 
-error_log /var/log/nginx/error.log warn;
+
+def _cpu_count():
+    try:
+        count = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r", encoding="utf-8") as file:
+            quota, period = file.read().split()[:2]
+        if quota != "max":
+            count = min(count, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, count)
+
+
+def _worker_limits(targets, settings):
+    processes = settings["worker_processes"] or min(_cpu_count(), 8)
+    # Every WebSocket tab holds a client and an upstream connection, so budget
+    # for a few dozen long-lived sockets per device on top of the base pool.
+    connections = settings["worker_connections"] or min(
+        16384, max(1024, 512 + 256 * len(targets))
+    )
+    open_files = settings["max_open_files"] or connections * 2 + 256
+    return {
+        "processes": processes,
+        "connections": connections,
+        "open_files": open_files,
+    }
+
+
+def _render_referer_maps(targets, dynamic=False):
+    # One capture-based regex pulls the target index out of the referer; the
+    # per-target values are then exact-match keys, which nginx hashes. When the
+    # referer is missing, the routing cookie set on proxied pages decides.
+    # Requests under /proxy/N/ name their target directly.
+    lines = [
+        "    map $http_referer $proxy_referer_index {",
+        "        default \"\";",
+        "        ~*/proxy/(\\d+)/ $1;",
+        "    }",
+        "",
+        "    map $proxy_referer_index $proxy_fallback_index {",
+        f"        \"\" $cookie_{ROUTE_COOKIE};",
+        "        default $proxy_referer_index;",
+        "    }",
+        "",
+        "    map $request_uri $proxy_request_index {",
+        "        default \"\";",
+        "        ~^/proxy/(\\d+)/ $1;",
+        "    }",
+        "",
+        "    map $proxy_request_index $proxy_index {",
+        "        \"\" $proxy_fallback_index;",
+        "        default $proxy_request_index;",
+        "    }",
+        "",
+        # Limits and the access log go by the URI or Referer only: with the
+        # cookie fallback the landing page would count against the device
+        # opened last.
+        "    map $proxy_request_index $proxy_routed_index {",
+        "        \"\" $proxy_referer_index;",
+        "        default $proxy_request_index;",
+        "    }",
+        "",
+        "    map $sent_http_content_type $proxy_route_cookie {",
+        "        default \"\";",
+        f"        ~*^text/html \"{ROUTE_COOKIE}=$proxy_request_index; Path=$http_x_ingress_path/; SameSite=Lax; HttpOnly\";",
+        "    }",
+    ]
+    values = {
+        "proxy_target": lambda idx, target: (
+            f"{target['scheme']}://{target['host']}:{target['port']}"
+            if dynamic and not _is_ip(target["host"])
+            else f"{target['scheme']}://{_upstream_name(idx)}"
+        ),
+        "proxy_host": lambda idx, target: f"{target['host']}:{target['port']}",
+        "proxy_sni": lambda idx, target: target["host"],
+        "proxy_upstream_encoding": lambda idx, target: (
+            "$proxy_accept_encoding" if target["compress"] else ""
+        ),
+        "proxy_passthrough_encoding": lambda idx, target: (
+            "$http_accept_encoding" if target["compress"] else ""
+        ),
+    }
+    routed = [
+        (idx, target)
+        for idx, target in enumerate(targets, start=1)
+        if not target.get("skip")
+    ]
+    for variable, value in values.items():
+        default = value(*routed[0]) if len(targets) == 1 and routed else ""
+        lines += [
+            "",
+            f"    map $proxy_index ${variable} {{",
+            f"        default \"{default}\";",
+        ]
+        lines += [f"        {idx} \"{value(idx, target)}\";" for idx, target in routed]
+        lines.append("    }")
+    return "\n".join(lines)
+
+
+def _render_limits(targets):
+    # A zone has a single rate (and limit_conn a single cap), so targets are
+    # grouped by value; each group's key map is empty for other targets, and
+    # nginx does not account requests with an empty key.
+    blocks = []
+    directives = []
+    for option, kind in (("rate_limit", "rate"), ("conn_limit", "conn")):
+        groups = {}
+        for idx, target in enumerate(targets, start=1):
+            if target[option] and not target.get("skip"):
+                groups.setdefault(target[option], []).append(idx)
+        for value, indices in sorted(groups.items()):
+            key = f"$proxy_{kind}_key_{value}"
+            zone = f"target_{kind}_{value}"
+            lines = [f"    map $proxy_routed_index {key} {{", '        default "";']
+            lines += [f"        {idx} {idx};" for idx in indices]
+            lines.append("    }")
+            if kind == "rate":
+                lines.append(f"    limit_req_zone {key} zone={zone}:1m rate={value}r/s;")
+                directives.append(f"limit_req zone={zone} burst={value * 2} nodelay;")
+            else:
+                lines.append(f"    limit_conn_zone {key} zone={zone}:1m;")
+                directives.append(f"limit_conn {zone} {value};")
+            blocks.append("\n".join(lines))
+    if not directives:
+        return "", ""
+    directives += [
+        "limit_req_status 429;",
+        "limit_conn_status 429;",
+        "limit_req_log_level warn;",
+        "limit_conn_log_level warn;",
+    ]
+    http_block = "\n\n".join(blocks) + "\n\n"
+    server_block = "".join(f"\n        {line}" for line in directives) + "\n"
+    return http_block, server_block
+
+
+def _render_access_log(settings):
+    if not settings["metrics"]:
+        return "    access_log off;", ""
+    log = f"""    log_format webui_proxy escape=json '{{"target":"$proxy_routed_index","status":"$status",'
+        '"request_time":"$request_time","connect_time":"$upstream_connect_time",'
+        '"header_time":"$upstream_header_time","bytes_sent":"$bytes_sent",'
+        '"upstream_bytes":"$upstream_response_length","cache":"$upstream_cache_status",'
+        '"content_type":"$sent_http_content_type","limit_req":"$limit_req_status",'
+        '"limit_conn":"$limit_conn_status"}}';
+
+    access_log {ACCESS_LOG_PATH} webui_proxy buffer=64k flush=5s;"""
+    locations = f"""
+        location = /metrics {{
+            access_log off;
+            proxy_pass http://127.0.0.1:{METRICS_PORT};
+        }}
+
+        location = /nginx_status {{
+            access_log off;
+            allow 127.0.0.1;
+            deny all;
+            stub_status;
+        }}
+"""
+    return log, locations
+
+
+def _render_nginx_conf(targets, settings=None, down=(), snippets=None):
+    settings = settings or DEFAULT_SETTINGS
+    snippets = {} if snippets is None else snippets
+    resolver_block = _render_resolver(targets, settings)
+    dynamic = bool(resolver_block)
+    referer_map_block = _render_referer_maps(targets, dynamic)
+    cache_zone = _render_asset_cache(targets, settings)
+    cached = bool(cache_zone)
+    locations = _render_target_locations(targets, snippets, cached, down)
+    rewrite_server = ""
+    if cached:
+        rewrite_server = f"""
+    server {{
+        listen 127.0.0.1:{REWRITE_PORT};
+        server_name _;
+        access_log off;
+
+        {_render_target_locations(targets, snippets, down=down)}
+    }}
+"""
+
+    limits = _worker_limits(targets, settings)
+    access_log, metrics_locations = _render_access_log(settings)
+    limit_zones, limit_block = _render_limits(targets)
+    # Plain-text HTTP/2 (h2c) only works for clients that speak it with prior
+    # knowledge; the Supervisor's Ingress client uses HTTP/1.1, so it is opt-in.
+    listen = f"listen {LISTEN_PORT};"
+    if settings["http2"]:
+        # Before 1.25.1 only "listen ... http2" exists, which on a plain port
+        # speaks h2c alone and turns away the HTTP/1.1 Ingress client.
+        if (_nginx_version() or ()) >= HTTP2_MIN_VERSION:
+            listen += "\n        http2 on;"
+        else:
+            _log("http2 needs nginx 1.25.1 or newer, serving HTTP/1.1 only")
+    brotli_module = ""
+    static_block = "gzip_static on;\n            gzip_vary on;"
+    if _brotli_enabled():
+        brotli_module = f"load_module {BROTLI_MODULE_PATH};\n\n"
+        static_block += "\n            brotli_static on;"
+
+    return f"""{brotli_module}worker_processes {limits['processes']};
+worker_rlimit_nofile {limits['open_files']};
+
+pid {NGINX_PID_PATH};
+
+error_log {ERROR_LOG_PATH} warn;
 
 events {{
-    worker_connections 1024;
+    worker_connections {limits['connections']};
+    multi_accept on;
+    accept_mutex off;
 }}
 
 http {{
@@ -394,24 +1368,58 @@ http {{
     default_type application/octet-stream;
 
     sendfile on;
-    keepalive_timeout 65;
+    tcp_nopush on;
+    tcp_nodelay on;
+    keepalive_timeout {settings['keepalive_timeout']}s;
+    keepalive_requests {settings['keepalive_requests'] or 1000};
+    client_header_buffer_size {settings['header_buffer_size'] or 4}k;
+    large_client_header_buffers 4 {settings['large_header_buffer_size'] or 32}k;
+
+    open_file_cache max=1000 inactive=60s;
+    open_file_cache_valid 30s;
+    open_file_cache_min_uses 2;
+    open_file_cache_errors on;
 
     map $http_upgrade $connection_upgrade {{
         default upgrade;
-        '' close;
+        '' "";
     }}
 
+    map $uri $proxy_accept_encoding {{
+        default "";
+        "~*\.({PASSTHROUGH_EXTENSIONS})$" $http_accept_encoding;
+        ~^/(api|rpc)/ $http_accept_encoding;
+    }}
+
+{resolver_block}{_render_upstreams(targets, settings, dynamic)}
+{cache_zone}
 {referer_map_block}
 
+{limit_zones}{access_log}
+
     server {{
-        listen 8080;
+        {listen}
         server_name _;
 
-        root /app/html;
+        root {os.path.dirname(HTML_PATH)};
         index index.html;
-
+{limit_block}
         location = / {{
             try_files /index.html =404;
+            {static_block}
+            add_header Cache-Control "no-cache";
+        }}
+
+        location = /status.json {{
+            access_log off;
+            alias {STATUS_PATH};
+            open_file_cache off;
+            add_header Cache-Control "no-store";
+        }}
+{metrics_locations}
+        location ~ "^/webui-proxy\.[0-9a-f]{{12}}\.js$" {{
+            add_header Cache-Control "public, max-age=31536000, immutable";
+            {static_block}
         }}
 
         location /scripts/ {{
@@ -427,6 +1435,8 @@ http {{
             proxy_send_timeout 3600s;
             proxy_buffering off;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -434,9 +1444,12 @@ http {{
         location /glyphicons- {{
             if ($proxy_target = "") {{ return 404; }}
             proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_set_header Host $proxy_host;
             proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -444,9 +1457,12 @@ http {{
         location /fontawesome- {{
             if ($proxy_target = "") {{ return 404; }}
             proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_set_header Host $proxy_host;
             proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -454,9 +1470,12 @@ http {{
         location /fonts/ {{
             if ($proxy_target = "") {{ return 404; }}
             proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_set_header Host $proxy_host;
             proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -464,9 +1483,12 @@ http {{
         location /styles/ {{
             if ($proxy_target = "") {{ return 404; }}
             proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_set_header Host $proxy_host;
             proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -474,9 +1496,12 @@ http {{
         location ~* \.(woff2?|ttf|eot|otf)$ {{
             if ($proxy_target = "") {{ return 404; }}
             proxy_http_version 1.1;
+            proxy_set_header Connection "";
             proxy_set_header Host $proxy_host;
             proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -492,6 +1517,8 @@ http {{
             proxy_send_timeout 3600s;
             proxy_buffering off;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -507,6 +1534,8 @@ http {{
             proxy_send_timeout 3600s;
             proxy_buffering off;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
@@ -522,29 +1551,212 @@ http {{
             proxy_send_timeout 3600s;
             proxy_buffering off;
             proxy_ssl_server_name on;
+            proxy_ssl_name $proxy_sni;
+            proxy_ssl_session_reuse on;
             proxy_ssl_verify off;
             proxy_pass $proxy_target;
         }}
 
-        {''.join(locations)}
+        {locations}
     }}
-}}
+{rewrite_server}}}
 """
 
 
-def main():
-    targets, restored = _load_targets()
-    _write_backup(targets)
-    if restored:
-        _update_supervisor_options(targets)
+def _log(message):
+    print(f"[webui-proxy] {message}", file=sys.stderr, flush=True)
+
+
+def _nginx_test(conf_path):
+    try:
+        result = subprocess.run(
+            ["nginx", "-t", "-q", "-c", conf_path],
+            capture_output=True,
+            text=True,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired) as err:
+        _log(f"nginx -t failed to run: {err}")
+        return False
+    if result.returncode != 0:
+        _log(f"nginx -t rejected the new config: {result.stderr.strip()}")
+        return False
+    return True
+
+
+def _signal_nginx(signum):
+    try:
+        with open(NGINX_PID_PATH, "r", encoding="utf-8") as file:
+            pid = int(file.read().strip())
+        os.kill(pid, signum)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _down_targets():
+    try:
+        status = _load_json(STATUS_PATH) or {}
+    except (OSError, ValueError):
+        return set()
+    return set(status.get("down") or ())
+
+
+@contextlib.contextmanager
+def _render_lock():
+    os.makedirs(os.path.dirname(LOCK_PATH), exist_ok=True)
+    with open(LOCK_PATH, "w", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_outputs(targets, settings, validate=False):
+    changed = []
+    os.makedirs(os.path.dirname(ACCESS_LOG_PATH), exist_ok=True)
+    html_dir = os.path.dirname(HTML_PATH)
+    bootstrap_path = os.path.join(html_dir, _bootstrap_name())
+    if _write_static(bootstrap_path, BOOTSTRAP_JS):
+        changed.append(bootstrap_path)
+    targets = _check_targets(targets, settings)
+    snippets = {}
+    conf = _render_nginx_conf(targets, settings, _down_targets(), snippets)
+    for name, content in snippets.items():
+        _write_text(os.path.join(SNIPPET_DIR, name), content)
+    if _file_digest(NGINX_CONF_PATH) != hashlib.sha256(conf.encode("utf-8")).digest():
+        candidate = f"{NGINX_CONF_PATH}.new"
+        _write_text(candidate, conf)
+        if validate and not _nginx_test(candidate):
+            os.remove(candidate)
+            return None
+        os.replace(candidate, NGINX_CONF_PATH)
+        changed.append(NGINX_CONF_PATH)
+    for name in os.listdir(html_dir):
+        if name.startswith("webui-proxy.") and not name.startswith(_bootstrap_name()):
+            os.remove(os.path.join(html_dir, name))
+    for name in os.listdir(SNIPPET_DIR):
+        if name not in snippets:
+            os.remove(os.path.join(SNIPPET_DIR, name))
+    if _write_static(HTML_PATH, _render_index(targets)):
+        changed.append(HTML_PATH)
+    if _write_backup(targets):
+        changed.append(BACKUP_PATH)
+    _log(f"changed: {', '.join(changed)}" if changed else "all outputs up to date")
+    return changed
+
+
+def _reload(targets, settings):
+    with _render_lock():
+        changed = _write_outputs(targets, settings, validate=True)
+    if changed is None:
+        return False
+    if NGINX_CONF_PATH in changed and _signal_nginx(signal.SIGHUP):
+        _log(f"reloaded nginx with {len(targets)} target(s)")
+    return True
 
-    os.makedirs(os.path.dirname(HTML_PATH), exist_ok=True)
-    with open(HTML_PATH, "w", encoding="utf-8") as file:
-        file.write(_render_index(targets))
 
-    os.makedirs(os.path.dirname(NGINX_CONF_PATH), exist_ok=True)
-    with open(NGINX_CONF_PATH, "w", encoding="utf-8") as file:
-        file.write(_render_nginx_conf(targets))
+def _inotify_fd(path):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    # IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE: the Supervisor may write the
+    # file in place or replace it, so watch the directory rather than the inode.
+    mask = 0x008 | 0x080 | 0x100
+    if libc.inotify_add_watch(fd, os.path.dirname(path).encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _inotify_touched(fd, name):
+    touched = False
+    try:
+        data = os.read(fd, 4096)
+    except BlockingIOError:
+        return False
+    offset = 0
+    while offset + 16 <= len(data):
+        _, _, _, length = struct.unpack_from("iIII", data, offset)
+        event_name = data[offset + 16 : offset + 16 + length].rstrip(b"\0")
+        touched = touched or event_name.decode(errors="ignore") == name
+        offset += 16 + length
+    return touched
+
+
+def _options_stamp():
+    try:
+        stat = os.stat(OPTIONS_PATH)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _watch():
+    targets, _ = _load_targets()
+    current = json.dumps([targets, _load_settings()], sort_keys=True)
+    try:
+        fd = _inotify_fd(OPTIONS_PATH)
+    except (AttributeError, OSError):
+        fd = None
+    if fd is None:
+        _log(f"inotify unavailable, polling {OPTIONS_PATH} every {WATCH_INTERVAL}s")
+    stamp = _options_stamp()
+    while True:
+        if fd is not None:
+            ready, _, _ = select.select([fd], [], [], WATCH_INTERVAL)
+            if ready and _inotify_touched(fd, os.path.basename(OPTIONS_PATH)):
+                # Let the writer finish before reading the file back.
+                time.sleep(0.5)
+        else:
+            time.sleep(WATCH_INTERVAL)
+        new_stamp = _options_stamp()
+        if new_stamp == stamp:
+            continue
+        stamp = new_stamp
+        try:
+            targets, _ = _load_targets()
+            settings = _load_settings()
+        except (OSError, ValueError) as err:
+            _log(f"cannot read {OPTIONS_PATH}: {err}")
+            continue
+        state = json.dumps([targets, settings], sort_keys=True)
+        if state == current:
+            continue
+        if _reload(targets, settings):
+            current = state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render Web UI Proxy config.")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and reload nginx when the add-on options change",
+    )
+    parser.add_argument(
+        "--sync-options",
+        action="store_true",
+        help="push the current targets to the Supervisor, retrying with backoff",
+    )
+    args = parser.parse_args(argv)
+    if args.watch:
+        _watch()
+        return
+    if args.sync_options:
+        targets, _ = _load_targets()
+        _sync_supervisor_options(targets)
+        return
+
+    started = time.monotonic()
+    targets, restored = _load_targets()
+    settings = _load_settings()
+    _write_outputs(targets, settings)
+    _log(f"rendered {len(targets)} target(s) in {(time.monotonic() - started) * 1000:.0f} ms")
+    if restored:
+        _spawn_supervisor_sync()
 
 
 if __name__ == "__main__":
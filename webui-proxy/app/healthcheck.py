@@ -0,0 +1,138 @@
+import asyncio
+import contextlib
+import json
+import ssl
+import time
+
+import generate
+
+MAX_BACKOFF = 300
+IDLE_INTERVAL = 60
+# A reload starts a new generation of nginx workers while the old ones wait
+# for their WebSockets and long polls, so a flapping device must not trigger
+# one per probe.
+DOWN_AFTER = 3
+UP_AFTER = 2
+RELOAD_INTERVAL = 60
+
+
+def _ssl_context():
+    # Devices behind the proxy use self-signed certificates; nginx does not
+    # verify them either (proxy_ssl_verify off).
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def _probe(target, settings, ssl_context):
+    timeout = settings["health_timeout"] or 3
+    use_tls = target["scheme"] == "https"
+    started = time.monotonic()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                target["host"],
+                target["port"],
+                ssl=ssl_context if use_tls else None,
+                server_hostname=target["host"] if use_tls else None,
+            ),
+            timeout=timeout,
+        )
+        if settings["health_http"]:
+            writer.write(
+                (
+                    f"HEAD / HTTP/1.1\r\nHost: {generate._target_key(target)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("ascii")
+            )
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), timeout=timeout)
+            if not status_line.startswith(b"HTTP/"):
+                raise ConnectionError("invalid HTTP response")
+        latency = round((time.monotonic() - started) * 1000, 1)
+        return {"up": True, "latency_ms": latency, "error": ""}
+    # ValueError covers hostnames that fail IDNA encoding (UnicodeError).
+    except (OSError, asyncio.TimeoutError, ssl.SSLError, ValueError) as err:
+        return {"up": False, "latency_ms": None, "error": str(err) or type(err).__name__}
+    finally:
+        if writer is not None:
+            writer.close()
+            with contextlib.suppress(OSError, ssl.SSLError):
+                await writer.wait_closed()
+
+
+async def _run():
+    ssl_context = _ssl_context()
+    state = {}
+    down = generate._down_targets()
+    reloaded = time.monotonic() - RELOAD_INTERVAL
+    while True:
+        try:
+            targets, _ = generate._load_targets()
+            settings = generate._load_settings()
+        except (OSError, ValueError) as err:
+            generate._log(f"health check cannot read options: {err}")
+            await asyncio.sleep(IDLE_INTERVAL)
+            continue
+        interval = settings["health_interval"]
+        if not interval:
+            await asyncio.sleep(IDLE_INTERVAL)
+            continue
+
+        semaphore = asyncio.Semaphore(settings["health_concurrency"] or 1)
+        now = time.monotonic()
+        keys = {generate._target_key(target): target for target in targets}
+        due = [key for key in keys if state.get(key, {}).get("next", 0) <= now]
+
+        async def check(key):
+            async with semaphore:
+                return key, await _probe(keys[key], settings, ssl_context)
+
+        for key, result in await asyncio.gather(*(check(key) for key in due)):
+            entry = state.setdefault(key, {"failures": 0, "successes": 0, "down": key in down})
+            entry["failures"] = 0 if result["up"] else entry["failures"] + 1
+            entry["successes"] = entry["successes"] + 1 if result["up"] else 0
+            if entry["failures"] >= DOWN_AFTER:
+                entry["down"] = True
+            elif entry["successes"] >= UP_AFTER:
+                entry["down"] = False
+            delay = interval * 2 ** max(0, entry["failures"] - 1)
+            entry["next"] = time.monotonic() + min(delay, max(interval, MAX_BACKOFF))
+            entry["result"] = dict(result, checked=int(time.time()))
+        for key in list(state):
+            if key not in keys:
+                del state[key]
+
+        statuses = {key: entry["result"] for key, entry in state.items()}
+        new_down = {key for key, entry in state.items() if entry["down"]}
+        changed = new_down != down and time.monotonic() - reloaded >= RELOAD_INTERVAL
+        if changed:
+            down = new_down
+        # The page shows the latest probe; the fast-fail list nginx renders
+        # from ("down") only changes together with a reload.
+        generate._write_text(
+            generate.STATUS_PATH,
+            json.dumps({"updated": int(time.time()), "targets": statuses, "down": sorted(down)}),
+        )
+        if changed:
+            reloaded = time.monotonic()
+            generate._log(
+                f"unreachable targets: {', '.join(sorted(down))}" if down
+                else "all targets reachable"
+            )
+            generate._reload(targets, settings)
+
+        next_due = min((entry["next"] for entry in state.values()), default=now + interval)
+        if new_down != down:
+            next_due = min(next_due, reloaded + RELOAD_INTERVAL)
+        await asyncio.sleep(max(1, next_due - time.monotonic()))
+
+
+def main():
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import signal
+import urllib.error
+import urllib.request
+
+import generate
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+REWRITE_TYPES = ("text/html", "text/css", "application/javascript", "text/javascript")
+LOG_MAX_BYTES = 8 * 1024 * 1024
+TAIL_INTERVAL = 2
+IDLE_INTERVAL = 30
+STUB_STATUS_URL = "http://127.0.0.1:8080/nginx_status"
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        for idx, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[idx] += 1
+
+
+class _Target:
+    def __init__(self):
+        self.requests = {}
+        self.bytes_sent = 0
+        self.rewritten_bytes = 0
+        self.websockets = 0
+        self.limited = {}
+        self.request_time = _Histogram()
+        self.connect_time = _Histogram()
+        self.header_time = _Histogram()
+
+
+def _seconds(value):
+    # Upstream timings list one value per attempt ("0.001, 0.004"), or "-".
+    total = 0.0
+    seen = False
+    for part in (value or "").split(","):
+        part = part.strip(" :")
+        if part and part != "-":
+            try:
+                total += float(part)
+                seen = True
+            except ValueError:
+                continue
+    return total if seen else None
+
+
+def _integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _target_indices():
+    try:
+        targets, _ = generate._load_targets()
+    except (OSError, ValueError):
+        return set()
+    return {str(idx) for idx in range(1, len(targets) + 1)}
+
+
+def _record(stats, line, indices):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return
+    # $proxy_index may come from the client's routing cookie; anything that is
+    # not a configured target would add a series per value.
+    key = entry.get("target")
+    target = stats.setdefault(key if key in indices else "none", _Target())
+    status = entry.get("status", "")
+    status_class = f"{status[:1]}xx" if status else "unknown"
+    target.requests[status_class] = target.requests.get(status_class, 0) + 1
+    target.bytes_sent += _integer(entry.get("bytes_sent"))
+    if status == "101":
+        target.websockets += 1
+    for limit in ("req", "conn"):
+        if entry.get(f"limit_{limit}") == "REJECTED":
+            target.limited[limit] = target.limited.get(limit, 0) + 1
+    content_type = entry.get("content_type", "")
+    if entry.get("cache") != "HIT" and content_type.startswith(REWRITE_TYPES):
+        target.rewritten_bytes += _integer(entry.get("upstream_bytes"))
+    for histogram, key in (
+        (target.request_time, "request_time"),
+        (target.connect_time, "connect_time"),
+        (target.header_time, "header_time"),
+    ):
+        value = _seconds(entry.get(key))
+        if value is not None:
+            histogram.observe(value)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _render_histogram(lines, name, target, histogram):
+    target = _label(target)
+    for bound, count in zip(BUCKETS, histogram.counts):
+        lines.append(f'{name}_bucket{{target="{target}",le="{bound}"}} {count}')
+    lines.append(f'{name}_bucket{{target="{target}",le="+Inf"}} {histogram.total}')
+    lines.append(f'{name}_sum{{target="{target}"}} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{{target="{target}"}} {histogram.total}')
+
+
+def _stub_status():
+    try:
+        with urllib.request.urlopen(STUB_STATUS_URL, timeout=2) as response:
+            text = response.read().decode("ascii", errors="ignore")
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+    lines = text.splitlines()
+    try:
+        active = int(lines[0].split(":")[1])
+        accepts, handled, requests = (int(value) for value in lines[2].split())
+        reading, writing, waiting = (int(value) for value in lines[3].split()[1::2])
+    except (IndexError, ValueError):
+        return None
+    return {
+        "connections_active": active,
+        "connections_accepted_total": accepts,
+        "connections_handled_total": handled,
+        "http_requests_total": requests,
+        "connections_reading": reading,
+        "connections_writing": writing,
+        "connections_waiting": waiting,
+    }
+
+
+def _render(stats):
+    lines = []
+    try:
+        targets, _ = generate._load_targets()
+    except (OSError, ValueError):
+        targets = []
+    lines.append("# TYPE webui_proxy_target_info gauge")
+    for idx, target in enumerate(targets, start=1):
+        lines.append(
+            f'webui_proxy_target_info{{target="{idx}",name="{_label(target["name"])}",'
+            f'upstream="{_label(generate._target_key(target))}"}} 1'
+        )
+
+    counters = (
+        ("webui_proxy_response_bytes_total", "bytes_sent"),
+        ("webui_proxy_rewritten_bytes_total", "rewritten_bytes"),
+        ("webui_proxy_websocket_sessions_total", "websockets"),
+    )
+    lines.append("# TYPE webui_proxy_requests_total counter")
+    for key, target in sorted(stats.items()):
+        for status_class, count in sorted(target.requests.items()):
+            lines.append(
+                f'webui_proxy_requests_total{{target="{_label(key)}",status="{status_class}"}} '
+                f"{count}"
+            )
+    lines.append("# TYPE webui_proxy_limited_requests_total counter")
+    for key, target in sorted(stats.items()):
+        for limit, count in sorted(target.limited.items()):
+            lines.append(
+                f'webui_proxy_limited_requests_total{{target="{_label(key)}",limit="{limit}"}} '
+                f"{count}"
+            )
+    for name, attribute in counters:
+        lines.append(f"# TYPE {name} counter")
+        for key, target in sorted(stats.items()):
+            lines.append(f'{name}{{target="{_label(key)}"}} {getattr(target, attribute)}')
+    for name, attribute in (
+        ("webui_proxy_request_duration_seconds", "request_time"),
+        ("webui_proxy_upstream_connect_seconds", "connect_time"),
+        ("webui_proxy_upstream_header_seconds", "header_time"),
+    ):
+        lines.append(f"# TYPE {name} histogram")
+        for key, target in sorted(stats.items()):
+            _render_histogram(lines, name, key, getattr(target, attribute))
+
+    status = _stub_status()
+    if status:
+        for name, value in status.items():
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines.append(f"# TYPE nginx_{name} {kind}")
+            lines.append(f"nginx_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _enabled():
+    try:
+        return generate._load_settings()["metrics"]
+    except (OSError, ValueError):
+        return True
+
+
+def _rotate():
+    rotated = f"{generate.ACCESS_LOG_PATH}.1"
+    try:
+        os.replace(generate.ACCESS_LOG_PATH, rotated)
+    except OSError:
+        return
+    # SIGUSR1 makes the nginx master reopen its log files.
+    generate._signal_nginx(signal.SIGUSR1)
+
+
+async def _tail(stats):
+    handle = None
+    inode = None
+    stamp = None
+    indices = set()
+    while True:
+        options = generate._options_stamp()
+        if options != stamp:
+            stamp = options
+            indices = _target_indices()
+        try:
+            current = os.stat(generate.ACCESS_LOG_PATH)
+        except OSError:
+            current = None
+        # The exporter keeps running with metrics off: the watcher may turn
+        # them on later, and whatever nginx still writes needs rotating.
+        if current is None and handle is None and not _enabled():
+            await asyncio.sleep(IDLE_INTERVAL)
+            continue
+        if current is not None and current.st_ino != inode:
+            if handle is not None:
+                for line in handle:
+                    _record(stats, line, indices)
+                handle.close()
+            handle = open(generate.ACCESS_LOG_PATH, "r", encoding="utf-8", errors="ignore")
+            inode = current.st_ino
+        if handle is not None:
+            for line in handle:
+                _record(stats, line, indices)
+            if current is not None and current.st_size > LOG_MAX_BYTES:
+                _rotate()
+        await asyncio.sleep(TAIL_INTERVAL)
+
+
+async def _serve(stats, reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split()[1:2] == [b"/metrics"]:
+            body = (await asyncio.to_thread(_render, stats)).encode("utf-8")
+            head = "HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+        else:
+            body = b"not found\n"
+            head = "HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n"
+        writer.write(
+            f"{head}Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _run():
+    stats = {}
+    server = await asyncio.start_server(
+        lambda reader, writer: _serve(stats, reader, writer),
+        "127.0.0.1",
+        generate.METRICS_PORT,
+    )
+    async with server:
+        await asyncio.gather(server.serve_forever(), _tail(stats))
+
+
+def main():
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,949 @@
+import asyncio
+import base64
+import codecs
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import ssl
+import tempfile
+import zlib
+
+import generate
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 16 * 1024
+# Longest construct the tokenizers wait for across chunk boundaries; longer
+# tags and URL leads are passed through unchanged.
+MAX_TAG = 16 * 1024
+HOLD = 256
+HEAD_LIMIT = 256 * 1024
+CONNECT_TIMEOUT = 10
+IDLE_TIMEOUT = 75
+POOL_SIZE = 8
+GZIP_LEVEL = 5
+# Bumped whenever the rewriting changes, so browsers drop copies made by an
+# older version.
+VERSION = "1"
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+REWRITE_KINDS = (
+    ("html", ("text/html",)),
+    ("css", generate.REWRITE_TYPES["css"]),
+    ("js", generate.REWRITE_TYPES["js"]),
+)
+URL_ATTRIBUTES = {
+    "action",
+    "background",
+    "cite",
+    "data",
+    "formaction",
+    "href",
+    "icon",
+    "longdesc",
+    "manifest",
+    "poster",
+    "src",
+    "xlink:href",
+}
+SRCSET_ATTRIBUTES = {"srcset", "imagesrcset"}
+TAG = re.compile(
+    r"<(?:!--.*?-->|[!?][^>]*>|(/?)([A-Za-z][^\s/>]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>)",
+    re.S,
+)
+TAG_START = re.compile(r"<(?:[!?/A-Za-z]|$)")
+RAW_END = re.compile(r"</(script|style)(?=[\s/>]|$)", re.I)
+# Tags without a value that looks like a URL, or an attribute holding CSS, JS
+# or a URL list, are copied without parsing their attributes.
+ATTRIBUTE_HINT = re.compile(
+    r"=\s*[\"']?\s*(?:/|https?:)|\b(?:style|on[a-z]+|content|srcset|imagesrcset)\s*=", re.I
+)
+ATTRIBUTE = re.compile(r"([^\s\"'>/=]+)(\s*=\s*)(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'=<>`]+))")
+REFRESH = re.compile(r"(;\s*url\s*=\s*['\"]?)([^'\"]*)", re.I)
+DATA_PATH = re.compile(r"/(?:api|rpc|ws|scripts)/")
+SRCSET_CANDIDATE = re.compile(r"(\s*)([^\s,]+)")
+# Every URL the rules touch is a root path right after a quote, paren or
+# "=" (maybe with spaces), a protocol-relative host, or a bare font file in
+# url(). Scanning for those costs one character-class test per character;
+# the lead in front of a candidate is only checked when one is found.
+CANDIDATE = re.compile(
+    r"[\"'`(=]\s{0,16}/(?!/)|//|[uU][rR][lL]\(\s{0,16}[\"']?(?=(?:glyphicons|fontawesome)-)"
+)
+# Leads after which a root path is rewritten, by rule pack and content kind.
+LEADS = {
+    "core": {
+        "css": (r"url\(\s{0,16}[\"']?", r"@import\s{1,16}[\"']"),
+        "js": (
+            r"\b(?:href|src|action)=\\?[\"']?",
+            r"\burl\(\s{0,16}\\?[\"']?",
+            r"\bimport\s{0,16}\(\s{0,16}[\"'`]",
+            r"\b(?:import|from)\s{0,16}[\"']",
+            r"\bnew\s{1,16}(?:Shared)?Worker\(\s{0,16}[\"'`]",
+        ),
+    },
+    "webpack": {"js": (r"\.p\s{0,16}=\s{0,16}[\"']", r"\bpublicPath\s{0,16}:\s{0,16}[\"']")},
+}
+# Paths rewritten after any quote, by rule pack and content kind.
+QUOTED_PATHS = {
+    "api": {"js": r"/(?:api|rpc|ws|scripts)/"},
+    "fonts": {"css": r"/glyphicons-", "js": r"/glyphicons-"},
+}
+LEAD_WINDOW = 64
+
+
+def _header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _without(headers, names):
+    return [(key, value) for key, value in headers if key.lower() not in names]
+
+
+def _accepts(headers, coding):
+    for part in (_header(headers, "Accept-Encoding") or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() not in (coding, "*"):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class _Context:
+    # Values of one target as seen from one Ingress session.
+    rule_sets = {}
+
+    def __init__(self, target, base, ingress):
+        self.base = base.rstrip("/")
+        self.ingress = ingress.rstrip("/")
+        self.packs = generate._target_packs(target)
+        hosts = "|".join(
+            re.escape(host) for host in (generate._target_key(target), target["host"])
+        )
+        self.host = re.compile(f"(?:{hosts})(?=/|$)", re.I)
+        self.absolute = re.compile(f"(?:https?:)?//(?:{hosts})(?=/|$)", re.I)
+        self.etag_prefix = hashlib.sha256(
+            f"{VERSION}:{','.join(sorted(self.packs))}:{self.base}".encode("utf-8")
+        ).hexdigest()[:8]
+
+    def rules(self, kind):
+        key = (kind, tuple(sorted(self.packs)))
+        if key not in self.rule_sets:
+            leads = [
+                lead
+                for pack, kinds in LEADS.items()
+                if pack in self.packs
+                for lead in kinds.get(kind, ())
+            ]
+            paths = [
+                kinds[kind]
+                for pack, kinds in QUOTED_PATHS.items()
+                if pack in self.packs and kind in kinds
+            ]
+            self.rule_sets[key] = (
+                re.compile(f"(?:{'|'.join(leads)})\\Z", re.I) if leads else None,
+                re.compile("|".join(paths)) if paths else None,
+                "fonts" in self.packs and kind == "css",
+            )
+        return self.rule_sets[key]
+
+    def rooted(self, string, pos):
+        # The device already produced a proxied or Ingress URL.
+        return string.startswith(self.ingress[1:] + "/", pos) if self.ingress else False
+
+    def url(self, value):
+        stripped = value.lstrip()
+        match = self.absolute.match(stripped)
+        if match:
+            return self.base + (stripped[match.end():] or "/")
+        if value.startswith("/") and not value.startswith("//") and not self.rooted(value, 1):
+            return self.base + value
+        return value
+
+    def text(self, kind, value):
+        return _TextRewriter(self, kind).feed(value, True)
+
+    def injection(self):
+        head = generate._head_injection()
+        return (
+            head[len("<head>"):]
+            .replace(generate.PROXY_BASE, self.base)
+            .replace("$http_x_ingress_path", self.ingress)
+        )
+
+
+class _TextRewriter:
+    # Streams CSS or JS, holding back the last few hundred characters in case
+    # a URL is split between chunks. Already emitted text stays around as
+    # the window the leads are matched in.
+    def __init__(self, context, kind):
+        self.context = context
+        self.leads, self.paths, self.fonts = context.rules(kind)
+        self.before = ""
+        self.pending = ""
+
+    def _replace(self, buffer, match, pos):
+        context = self.context
+        found = match.group(0)
+        if found == "//":
+            host = context.host.match(buffer, match.end())
+            if not host:
+                return None
+            start = match.start()
+            for scheme in ("https:", "http:"):
+                if buffer[start - len(scheme):start].lower() == scheme:
+                    start -= len(scheme)
+                    break
+            return max(start, pos), host.end(), context.base
+        if found[0] in "uU":
+            return (match.end(), match.end(), context.base + "/") if self.fonts else None
+        slash = match.end() - 1
+        if context.rooted(buffer, slash + 1):
+            return None
+        if (self.leads and self.leads.search(buffer, max(0, slash - LEAD_WINDOW), slash)) or (
+            found[0] in "\"'`" and self.paths and self.paths.match(buffer, slash)
+        ):
+            return slash, slash, context.base
+        return None
+
+    def feed(self, text, final=False):
+        buffer = self.before + self.pending + text
+        start = len(self.before)
+        cut = len(buffer) if final else max(start, len(buffer) - HOLD)
+        out = []
+        pos = start
+        for match in CANDIDATE.finditer(buffer, start):
+            if match.start() >= cut:
+                break
+            found = self._replace(buffer, match, pos)
+            if found is None:
+                continue
+            begin, finish, replacement = found
+            out.append(buffer[pos:begin])
+            out.append(replacement)
+            pos = finish
+        # A scheme in front of a held-back "//" must not be emitted yet.
+        end = len(buffer) if final else max(pos, cut - len("https:"))
+        out.append(buffer[pos:end])
+        self.before = buffer[max(0, end - LEAD_WINDOW):end]
+        self.pending = buffer[end:]
+        return "".join(out)
+
+
+class _HtmlRewriter:
+    # A small streaming tokenizer: text between tags is copied, each complete
+    # tag has its URL attributes rewritten, and <script>/<style> bodies go
+    # through the JS and CSS rewriters until their end tag.
+    def __init__(self, context):
+        self.context = context
+        self.pending = ""
+        self.raw = None
+        self.raw_rewriter = None
+        self.injected = False
+
+    def _attribute(self, tag, attributes, match):
+        name = match.group(1).lower()
+        value = next(group for group in match.group(3, 4, 5) if group is not None)
+        context = self.context
+        if name in URL_ATTRIBUTES:
+            rewritten = context.url(value)
+        elif name in SRCSET_ATTRIBUTES:
+            rewritten = ",".join(
+                SRCSET_CANDIDATE.sub(
+                    lambda part: part.group(1) + context.url(part.group(2)), candidate, count=1
+                )
+                for candidate in value.split(",")
+            )
+        elif name == "style":
+            rewritten = context.text("css", value)
+        elif name.startswith("on"):
+            rewritten = context.text("js", value)
+        elif name == "content" and tag == "meta" and "refresh" in attributes.lower():
+            rewritten = REFRESH.sub(
+                lambda part: part.group(1) + context.url(part.group(2)), value, count=1
+            )
+        elif ("api" in context.packs and DATA_PATH.match(value)) or value.startswith(("http", "//")):
+            rewritten = context.url(value)
+        else:
+            return match.group(0)
+        if rewritten == value:
+            return match.group(0)
+        if match.group(3) is not None:
+            quoted = f'"{rewritten}"'
+        elif match.group(4) is not None:
+            quoted = f"'{rewritten}'"
+        else:
+            quoted = rewritten
+        return f"{match.group(1)}{match.group(2)}{quoted}"
+
+    def _tag(self, match):
+        closing, name, attributes = match.group(1, 2, 3)
+        if name is None or closing:
+            return match.group(0)
+        name = name.lower()
+        out = match.group(0)
+        if ATTRIBUTE_HINT.search(attributes):
+            attributes = ATTRIBUTE.sub(
+                lambda item: self._attribute(name, match.group(3), item), attributes
+            )
+            out = f"<{match.group(2)}{attributes}>"
+        if name in ("script", "style") and not attributes.rstrip().endswith("/"):
+            self.raw = name
+            self.raw_rewriter = _TextRewriter(self.context, "js" if name == "script" else "css")
+        if name == "head" and not self.injected:
+            self.injected = True
+            out += self.context.injection()
+        return out
+
+    def feed(self, text, final=False):
+        buffer = self.pending + text
+        out = []
+        pos = 0
+        while pos < len(buffer):
+            if self.raw:
+                end = None
+                for match in RAW_END.finditer(buffer, pos):
+                    if match.group(1).lower() == self.raw:
+                        end = match
+                        break
+                if end is None:
+                    stop = len(buffer) if final else max(pos, len(buffer) - len(self.raw) - 2)
+                    out.append(self.raw_rewriter.feed(buffer[pos:stop], final))
+                    pos = stop
+                    break
+                out.append(self.raw_rewriter.feed(buffer[pos:end.start()], True))
+                self.raw = self.raw_rewriter = None
+                pos = end.start()
+                continue
+            lt = buffer.find("<", pos)
+            if lt < 0:
+                out.append(buffer[pos:])
+                pos = len(buffer)
+                break
+            out.append(buffer[pos:lt])
+            pos = lt
+            match = TAG.match(buffer, lt)
+            if match is None:
+                if not final and len(buffer) - lt < MAX_TAG and TAG_START.match(buffer, lt):
+                    break
+                out.append("<")
+                pos = lt + 1
+                continue
+            out.append(self._tag(match))
+            pos = match.end()
+        self.pending = buffer[pos:]
+        return "".join(out)
+
+
+class _Decoder:
+    def __init__(self, coding):
+        if coding == "br":
+            self.stream = brotli.Decompressor()
+        else:
+            # 47 accepts both gzip and zlib headers; raw deflate is retried.
+            self.stream = zlib.decompressobj(47 if coding in ("gzip", "x-gzip") else 15)
+        self.coding = coding
+        self.raw = False
+
+    def decompress_step(self, data):
+        try:
+            return self.stream.decompress(data, CHUNK_SIZE * 4)
+        except zlib.error:
+            # Some servers send raw deflate without the zlib header.
+            if self.coding != "deflate" or self.raw:
+                raise
+            self.raw = True
+            self.stream = zlib.decompressobj(-15)
+            return self.stream.decompress(data, CHUNK_SIZE * 4)
+
+    def decompress(self, data):
+        # Bounded steps, so a small compressed body cannot expand into one
+        # huge string.
+        if self.coding == "br":
+            yield self.stream.process(data)
+            return
+        while data:
+            piece = self.decompress_step(data)
+            yield piece
+            data = self.stream.unconsumed_tail
+
+    def flush(self):
+        return b"" if self.coding == "br" else self.stream.flush()
+
+
+def _charset(content_type):
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "charset":
+            try:
+                return codecs.lookup(value.strip().strip("\"'")).name
+            except LookupError:
+                break
+    return "utf-8"
+
+
+def _kind(content_type):
+    media = content_type.split(";")[0].strip().lower()
+    for kind, types in REWRITE_KINDS:
+        if media in types:
+            return kind
+    return None
+
+
+def _wrap_etag(context, etag):
+    encoded = base64.urlsafe_b64encode(etag.encode("utf-8")).decode("ascii").rstrip("=")
+    return f'W/"rw{context.etag_prefix}.{encoded}"'
+
+
+def _unwrap_etag(context, value):
+    match = re.fullmatch(r'W/"rw([0-9a-f]{8})\.([\w-]*)"', value)
+    if not match or match.group(1) != context.etag_prefix:
+        return None
+    encoded = match.group(2)
+    try:
+        return base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class _Cache:
+    # Rewritten bodies, gzip-compressed, on disk and keyed by request; the
+    # device's ETag validates them. Only the index is kept in memory.
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        if limit:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry["size"]
+        try:
+            os.remove(entry["path"])
+        except OSError:
+            pass
+
+    def open(self):
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        return os.fdopen(fd, "wb"), path
+
+    def commit(self, key, tmp_path, etag, headers):
+        size = os.path.getsize(tmp_path)
+        if size > self.limit:
+            os.remove(tmp_path)
+            return
+        path = os.path.join(self.directory, key)
+        os.replace(tmp_path, path)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old["size"]
+        self.entries[key] = {"path": path, "size": size, "etag": etag, "headers": headers}
+        self.size += size
+        while self.size > self.limit:
+            self.drop(next(iter(self.entries)))
+
+
+class _Targets:
+    def __init__(self):
+        self.stamp = None
+        self.targets = []
+
+    def get(self, index):
+        stamp = generate._options_stamp()
+        if stamp != self.stamp or not self.targets:
+            self.stamp = stamp
+            try:
+                self.targets, _ = generate._load_targets()
+            except (OSError, ValueError) as err:
+                generate._log(f"rewriter cannot read targets: {err}")
+        try:
+            idx = int(index)
+        except (TypeError, ValueError):
+            return None
+        if 1 <= idx <= len(self.targets):
+            return self.targets[idx - 1]
+        return None
+
+
+class _Pool:
+    # Idle keep-alive connections to the devices, like nginx's upstream
+    # keepalive.
+    def __init__(self):
+        self.idle = {}
+        self.tls = ssl.create_default_context()
+        self.tls.check_hostname = False
+        self.tls.verify_mode = ssl.CERT_NONE
+
+    async def connect(self, target):
+        idle = self.idle.get(_pool_key(target), [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        tls = target["scheme"] == "https"
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                target["host"],
+                target["port"],
+                ssl=self.tls if tls else None,
+                server_hostname=target["host"] if tls else None,
+                limit=HEAD_LIMIT,
+            ),
+            CONNECT_TIMEOUT,
+        )
+        return reader, writer, False
+
+    def release(self, target, reader, writer):
+        idle = self.idle.setdefault(_pool_key(target), [])
+        if len(idle) < POOL_SIZE and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+
+def _pool_key(target):
+    return target["scheme"], target["host"], target["port"]
+
+
+async def _read_head(reader, timeout):
+    try:
+        data = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+    except asyncio.IncompleteReadError as err:
+        if err.partial.strip():
+            raise
+        return None
+    lines = data.decode("latin-1").split("\r\n")
+    start = lines[0].split(" ", 2)
+    if len(start) < 2:
+        raise ValueError(f"bad start line {lines[0]!r}")
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(":")
+        if not separator:
+            raise ValueError(f"bad header line {line!r}")
+        headers.append((name.strip(), value.strip()))
+    return start, headers
+
+
+def _framing(headers, response=False):
+    if "chunked" in (_header(headers, "Transfer-Encoding") or "").lower():
+        return "chunked"
+    length = _header(headers, "Content-Length")
+    if length is not None:
+        return int(length)
+    return "eof" if response else 0
+
+
+async def _body(reader, framing, timeout):
+    if framing == "chunked":
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(line.split(b";")[0].strip() or b"x", 16)
+            if not size:
+                while (await asyncio.wait_for(reader.readline(), timeout)) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size:
+                data = await asyncio.wait_for(reader.read(min(size, CHUNK_SIZE)), timeout)
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", size)
+                size -= len(data)
+                yield data
+            await asyncio.wait_for(reader.readexactly(2), timeout)
+    elif framing == "eof":
+        while True:
+            data = await asyncio.wait_for(reader.read(CHUNK_SIZE), timeout)
+            if not data:
+                return
+            yield data
+    else:
+        remaining = framing
+        while remaining:
+            data = await asyncio.wait_for(reader.read(min(remaining, CHUNK_SIZE)), timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            yield data
+
+
+def _head(start, headers):
+    lines = [start] + [f"{name}: {value}" for name, value in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def _send(writer, data, chunked):
+    if not data:
+        return
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+    await writer.drain()
+
+
+async def _respond(writer, status, reason, message):
+    body = f"{message}\n".encode("utf-8")
+    writer.write(
+        _head(
+            f"HTTP/1.1 {status} {reason}",
+            [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))],
+        )
+        + body
+    )
+    await writer.drain()
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+class _Proxy:
+    def __init__(self, settings):
+        self.targets = _Targets()
+        self.pool = _Pool()
+        self.cache = _Cache(generate.REWRITER_CACHE_PATH, settings["cache_size"] * 1024 * 1024)
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                head = await _read_head(reader, IDLE_TIMEOUT)
+                if head is None or not await self.handle(reader, writer, *head):
+                    break
+        except DECODE_ERRORS + (
+            OSError,
+            ValueError,
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, reader, writer, start, headers):
+        method, path, version = (start + ["HTTP/1.0"])[:3]
+        keep_alive = version == "HTTP/1.1" and "close" not in (
+            _header(headers, "Connection") or ""
+        ).lower()
+        framing = _framing(headers)
+        index = _header(headers, "X-Webui-Proxy-Target")
+        target = self.targets.get(index)
+        if target is None:
+            async for _ in _body(reader, framing, IDLE_TIMEOUT):
+                pass
+            await _respond(writer, 502, "Bad Gateway", f"unknown target {index}")
+            return keep_alive
+        ingress = _header(headers, "X-Ingress-Path") or ""
+        context = _Context(
+            target, _header(headers, "X-Forwarded-Prefix") or f"{ingress}/proxy/{index}", ingress
+        )
+        timeout = generate.PROFILES[target["profile"]]["timeout"]
+        upgrade = "upgrade" in (_header(headers, "Connection") or "").lower()
+
+        request_headers = _without(
+            headers,
+            HOP_HEADERS | {"x-webui-proxy-target", "accept-encoding", "if-none-match"},
+        )
+        if upgrade:
+            request_headers += [("Connection", "upgrade"), ("Upgrade", _header(headers, "Upgrade"))]
+        if framing == "chunked":
+            request_headers.append(("Transfer-Encoding", "chunked"))
+        codings = [
+            coding
+            for coding in ("gzip", "deflate") + (("br",) if brotli else ())
+            if target["compress"] and _accepts(headers, coding)
+        ]
+        if codings:
+            request_headers.append(("Accept-Encoding", ", ".join(codings)))
+
+        # Validators: ETags the client got from us map back to the device's,
+        # and a cached copy adds its own.
+        key = entry = None
+        if method == "GET" and self.cache.limit and not _header(headers, "Authorization"):
+            key = hashlib.sha256(
+                json.dumps(
+                    [_pool_key(target), context.base, context.ingress, path, sorted(context.packs)]
+                ).encode("utf-8")
+            ).hexdigest()
+            entry = self.cache.get(key)
+        client_tags = []
+        validators = []
+        for tag in (_header(headers, "If-None-Match") or "").split(","):
+            tag = tag.strip()
+            if not tag:
+                continue
+            upstream = _unwrap_etag(context, tag)
+            if upstream:
+                client_tags.append(upstream)
+            validators.append(upstream or tag)
+        if entry and entry["etag"] not in validators:
+            validators.append(entry["etag"])
+        if validators:
+            request_headers.append(("If-None-Match", ", ".join(validators)))
+        request_head = _head(f"{method} {path} HTTP/1.1", request_headers)
+
+        for attempt in range(2):
+            try:
+                up_reader, up_writer, reused = await self.pool.connect(target)
+            except asyncio.TimeoutError:
+                await _respond(writer, 504, "Gateway Timeout", "device connect timeout")
+                return False
+            except OSError as err:
+                await _respond(writer, 502, "Bad Gateway", f"cannot reach device: {err}")
+                return False
+            try:
+                up_writer.write(request_head)
+                if framing:
+                    async for data in _body(reader, framing, timeout):
+                        await _send(up_writer, data, framing == "chunked")
+                    if framing == "chunked":
+                        up_writer.write(b"0\r\n\r\n")
+                await up_writer.drain()
+                response = await _read_head(up_reader, timeout)
+                while response and 100 <= int(response[0][1]) < 200 and response[0][1] != "101":
+                    response = await _read_head(up_reader, timeout)
+                if response is None:
+                    raise ConnectionResetError("device closed the connection")
+                break
+            except (OSError, asyncio.IncompleteReadError) as err:
+                up_writer.close()
+                # A kept-alive connection the device has since closed; only
+                # safe to retry when no request body was consumed.
+                if reused and not framing and attempt == 0:
+                    continue
+                await _respond(writer, 502, "Bad Gateway", f"device error: {err}")
+                return False
+            except asyncio.TimeoutError:
+                up_writer.close()
+                await _respond(writer, 504, "Gateway Timeout", "device response timeout")
+                return False
+
+        (_, status, *reason), response_headers = response
+        status = int(status)
+        status_line = f"HTTP/1.1 {status} {reason[0] if reason else ''}".rstrip()
+
+        if status == 101 and upgrade:
+            writer.write(_head(status_line, response_headers))
+            await writer.drain()
+            await asyncio.gather(_pipe(reader, up_writer), _pipe(up_reader, writer))
+            return False
+
+        etag = _header(response_headers, "ETag")
+        if status == 304:
+            up_framing = None
+        else:
+            up_framing = None if method == "HEAD" or status == 204 else _framing(
+                response_headers, response=True
+            )
+        reusable = up_framing != "eof" and "close" not in (
+            _header(response_headers, "Connection") or ""
+        ).lower()
+        gzip_out = target["compress"] and _accepts(headers, "gzip")
+
+        if status == 304 and client_tags and (etag is None or etag in client_tags):
+            headers_out = _without(response_headers, HOP_HEADERS | {"etag"})
+            headers_out.append(("ETag", _wrap_etag(context, etag or client_tags[0])))
+            writer.write(_head(status_line, headers_out))
+            await writer.drain()
+            self._release(target, up_reader, up_writer, reusable)
+            return keep_alive
+        if status == 304 and entry and (etag is None or etag == entry["etag"]):
+            self._release(target, up_reader, up_writer, reusable)
+            await self._serve_cached(writer, context, entry, response_headers, gzip_out)
+            return keep_alive
+
+        content_type = _header(response_headers, "Content-Type") or ""
+        coding = (_header(response_headers, "Content-Encoding") or "identity").strip().lower()
+        kind = _kind(content_type) if up_framing is not None else None
+        if kind is None or coding not in ("identity", "gzip", "x-gzip", "deflate") + (
+            ("br",) if brotli else ()
+        ):
+            headers_out = _without(response_headers, HOP_HEADERS)
+            chunked = up_framing in ("chunked", "eof")
+            if chunked:
+                headers_out.append(("Transfer-Encoding", "chunked"))
+            writer.write(_head(status_line, headers_out))
+            try:
+                if up_framing is not None:
+                    async for data in _body(up_reader, up_framing, timeout):
+                        await _send(writer, data, chunked)
+                    if chunked:
+                        writer.write(b"0\r\n\r\n")
+                await writer.drain()
+            except BaseException:
+                up_writer.close()
+                raise
+            self._release(target, up_reader, up_writer, reusable)
+            return keep_alive
+
+        cache_control = (_header(response_headers, "Cache-Control") or "").lower()
+        cacheable = (
+            key
+            and status == 200
+            and etag
+            and not _header(response_headers, "Set-Cookie")
+            and "no-store" not in cache_control
+            and "private" not in cache_control
+            and (_header(response_headers, "Vary") or "accept-encoding").lower().strip()
+            == "accept-encoding"
+        )
+        stored = _without(
+            response_headers,
+            HOP_HEADERS
+            | {"content-length", "content-encoding", "etag", "accept-ranges", "content-md5", "vary"},
+        )
+        headers_out = list(stored)
+        if etag:
+            headers_out.append(("ETag", _wrap_etag(context, etag)))
+        headers_out.append(("Vary", "Accept-Encoding"))
+        if gzip_out:
+            headers_out.append(("Content-Encoding", "gzip"))
+        headers_out.append(("Transfer-Encoding", "chunked"))
+        writer.write(_head(status_line, headers_out))
+
+        charset = _charset(content_type)
+        decoder = None if coding == "identity" else _Decoder(coding)
+        text_decoder = codecs.getincrementaldecoder(charset)(errors="surrogateescape")
+        rewriter = _HtmlRewriter(context) if kind == "html" else _TextRewriter(context, kind)
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if gzip_out else None
+        cache_file = cache_path = cache_compressor = None
+        if cacheable:
+            cache_file, cache_path = self.cache.open()
+            if not gzip_out:
+                cache_compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+        async def emit(text, final=False):
+            data = text.encode(charset, "surrogateescape")
+            wire = data
+            if compressor:
+                wire = compressor.compress(data) + (compressor.flush() if final else b"")
+            if cache_file:
+                if cache_compressor:
+                    cache_file.write(
+                        cache_compressor.compress(data)
+                        + (cache_compressor.flush() if final else b"")
+                    )
+                else:
+                    cache_file.write(wire)
+            await _send(writer, wire, True)
+
+        try:
+            async for data in _body(up_reader, up_framing, timeout):
+                pieces = decoder.decompress(data) if decoder else (data,)
+                for piece in pieces:
+                    await emit(rewriter.feed(text_decoder.decode(piece)))
+            tail = decoder.flush() if decoder else b""
+            await emit(rewriter.feed(text_decoder.decode(tail, True), True), True)
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except BaseException:
+            up_writer.close()
+            if cache_file:
+                cache_file.close()
+                os.remove(cache_path)
+            raise
+        if cache_file:
+            cache_file.close()
+            self.cache.commit(key, cache_path, etag, stored)
+        self._release(target, up_reader, up_writer, reusable)
+        return keep_alive
+
+    def _release(self, target, reader, writer, reusable):
+        if reusable:
+            self.pool.release(target, reader, writer)
+        else:
+            writer.close()
+
+    async def _serve_cached(self, writer, context, entry, fresh, gzip_out):
+        headers_out = [
+            (name, value)
+            for name, value in entry["headers"]
+            if name.lower() not in ("cache-control", "expires", "date", "last-modified")
+            or _header(fresh, name) is None
+        ]
+        for name in ("Cache-Control", "Expires", "Date", "Last-Modified"):
+            if _header(fresh, name) is not None:
+                headers_out.append((name, _header(fresh, name)))
+        headers_out += [("ETag", _wrap_etag(context, entry["etag"])), ("Vary", "Accept-Encoding")]
+        if gzip_out:
+            headers_out += [("Content-Encoding", "gzip"), ("Content-Length", str(entry["size"]))]
+        else:
+            headers_out.append(("Transfer-Encoding", "chunked"))
+        writer.write(_head("HTTP/1.1 200 OK", headers_out))
+        decompressor = None if gzip_out else zlib.decompressobj(31)
+        with open(entry["path"], "rb") as file:
+            while True:
+                data = file.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if decompressor:
+                    await _send(writer, decompressor.decompress(data), True)
+                else:
+                    await _send(writer, data, False)
+        if decompressor:
+            await _send(writer, decompressor.flush(), True)
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+DECODE_ERRORS = (zlib.error, UnicodeError) + ((brotli.error,) if brotli else ())
+
+
+async def _run():
+    proxy = _Proxy(generate._load_settings())
+    server = await asyncio.start_server(
+        proxy.serve, "127.0.0.1", generate.REWRITER_PORT, limit=HEAD_LIMIT
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Generator benchmark and golden-file regression check.
+
+Builds synthetic target lists in every format _parse_target accepts (bare
+host, host:port, URLs with a scheme, named objects with per-target options;
+the golden list also has a hostname target) and reports for each size:
+
+  parse ms    time to parse the raw option values
+  render ms   time to render nginx.conf
+  conf KiB    size of the rendered nginx.conf and its include snippets
+  nginx -t    config load time and peak RSS, when nginx is installed
+
+The rendered output for a few small lists is compared with the files in
+bench/golden/, and output size, render time and (with nginx) load time and
+RSS are compared with bench/golden/baseline.json. Any mismatch, regression or
+config nginx -t rejects makes the script exit with status 1. After an
+intended change, refresh both with --update.
+
+Usage: python3 bench/bench_generate.py [--update] [--sizes 10,100,500]
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import generate  # noqa: E402
+
+# Keep the output independent of the host's brotli module and resolv.conf.
+generate._brotli_enabled = lambda: False
+generate._nameservers = lambda: ["192.0.2.53"]
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "golden")
+BASELINE_PATH = os.path.join(GOLDEN_DIR, "baseline.json")
+SIZES = (10, 100, 500)
+REPEAT = 5
+# Render time depends on the machine, so only flag large slowdowns.
+TIME_TOLERANCE = 2.0
+TIME_SLACK_MS = 5.0
+SIZE_TOLERANCE = 1.02
+NGINX_SLACK_MS = 20.0
+RSS_TOLERANCE = 1.2
+# Fixed worker settings keep the output independent of the CPU count.
+SETTINGS = dict(
+    generate.DEFAULT_SETTINGS,
+    worker_processes=2,
+    worker_connections=2048,
+    max_open_files=8192,
+)
+GOLDEN_CASES = {
+    "formats": (SETTINGS, ()),
+    "formats-down": (SETTINGS, ("10.0.0.2:80",)),
+    "formats-plain": (dict(SETTINGS, cache_size=0, metrics=False, upstream_keepalive=0), ()),
+}
+
+
+def _raw_target(idx):
+    octets = f"10.{idx // 62500 % 250}.{idx // 250 % 250}.{idx % 250 + 1}"
+    kind = idx % 7
+    if kind == 0:
+        return octets
+    if kind == 1:
+        return f"{octets}:8123"
+    if kind == 2:
+        return f"http://{octets}:8080/"
+    if kind == 3:
+        return f"https://{octets}"
+    if kind == 4:
+        return f"{octets}:8443"
+    if kind == 5:
+        return {
+            "name": f"Device {idx}",
+            "url": f"http://{octets}:{5000 + idx % 1000}",
+            "profile": "bulk",
+            "passthrough": "/backup/download,/snapshot.cgi",
+            "conn_limit": 0,
+            "engine": "python",
+        }
+    return {
+        "name": f"Камера {idx} <\"&\">",
+        "url": f"https://{octets}:8006",
+        "compress": False,
+        "rules": "core,api",
+        "profile": "realtime",
+        "rate_limit": 20,
+        "max_conns": 8,
+    }
+
+
+def _targets(raw):
+    return [target for target in (generate._parse_target(item) for item in raw) if target]
+
+
+def _render(targets, settings, down=()):
+    snippets = {}
+    conf = generate._render_nginx_conf(targets, settings, down, snippets)
+    return conf, snippets
+
+
+def _combined(conf, snippets):
+    # nginx.conf followed by the include snippets it references.
+    parts = [conf]
+    for name, content in sorted(snippets.items()):
+        parts.append(f"# {generate.SNIPPET_DIR}/{name}\n{content}")
+    return "\n".join(parts)
+
+
+def _best(func):
+    timings = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000, result
+
+
+def _nginx_load(conf, snippets):
+    nginx = shutil.which("nginx")
+    if not nginx:
+        return None
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "nginx.conf")
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write(conf.replace(generate.SNIPPET_DIR, root))
+        for name, content in snippets.items():
+            with open(os.path.join(root, name), "w", encoding="utf-8") as handle:
+                handle.write(content)
+        started = time.perf_counter()
+        result = subprocess.run(
+            [nginx, "-t", "-q", "-c", path, "-p", root],
+            capture_output=True,
+            text=True,
+        )
+        elapsed = (time.perf_counter() - started) * 1000
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is the peak over all children so far; sizes run in ascending
+    # order, so it tracks the largest config loaded.
+    error = "" if result.returncode == 0 else (result.stderr.strip() or "nginx -t failed")
+    return elapsed, rss / 1024, error
+
+
+def _golden(update):
+    failures = []
+    raw = [_raw_target(idx) for idx in range(7)] + ["10.0.0.2", "https://nas.local:5001"]
+    targets = _targets(raw)
+    outputs = {
+        f"{name}.conf": _combined(*_render(targets, settings, down))
+        for name, (settings, down) in GOLDEN_CASES.items()
+    }
+    outputs["formats.html"] = generate._render_index(targets)
+    for name, content in outputs.items():
+        path = os.path.join(GOLDEN_DIR, name)
+        if update:
+            generate._write_text(path, content)
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as handle:
+                expected = handle.read()
+        except OSError:
+            failures.append(f"{name}: golden file missing, run with --update")
+            continue
+        if content != expected:
+            failures.append(f"{name}: rendered output differs from bench/golden/{name}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update", action="store_true", help="rewrite golden files and baseline")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in SIZES),
+        help="comma-separated target counts",
+    )
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+
+    failures = _golden(args.update)
+    baseline = generate._load_json(BASELINE_PATH) or {}
+    measured = {}
+
+    print(f"{'targets':>7} {'parse ms':>9} {'render ms':>10} {'conf KiB':>9} "
+          f"{'nginx -t ms':>12} {'nginx MiB':>10}")
+    for size in sizes:
+        raw = [_raw_target(idx) for idx in range(size)]
+        parse_ms, targets = _best(lambda: _targets(raw))
+        render_ms, (conf, snippets) = _best(lambda: _render(targets, SETTINGS))
+        size_bytes = len(_combined(conf, snippets).encode("utf-8"))
+        load = _nginx_load(conf, snippets)
+        expected = baseline.get(str(size))
+        measured[str(size)] = {"bytes": size_bytes, "render_ms": round(render_ms, 2)}
+        if load is None:
+            nginx_cols = f"{'n/a':>12} {'n/a':>10}"
+            # Keep the nginx numbers recorded on a machine that has it.
+            for key in ("nginx_ms", "nginx_mib"):
+                if expected and key in expected:
+                    measured[str(size)][key] = expected[key]
+        else:
+            load_ms, rss_mib, error = load
+            nginx_cols = f"{load_ms:>12.1f} {rss_mib:>10.1f}"
+            if error:
+                nginx_cols += "  (nginx -t failed)"
+                failures.append(f"{size} targets: nginx -t rejected the config: {error}")
+            else:
+                measured[str(size)].update(nginx_ms=round(load_ms, 1), nginx_mib=round(rss_mib, 1))
+        print(f"{size:>7} {parse_ms:>9.2f} {render_ms:>10.2f} {size_bytes / 1024:>9.1f} {nginx_cols}")
+
+        if args.update or not expected:
+            continue
+        if load is not None and not load[2] and "nginx_ms" in expected:
+            if load_ms > expected["nginx_ms"] * TIME_TOLERANCE + NGINX_SLACK_MS:
+                failures.append(
+                    f"{size} targets: nginx -t took {load_ms:.1f} ms "
+                    f"(baseline {expected['nginx_ms']:.1f} ms)"
+                )
+            if rss_mib > expected["nginx_mib"] * RSS_TOLERANCE:
+                failures.append(
+                    f"{size} targets: nginx peak RSS {rss_mib:.1f} MiB "
+                    f"(baseline {expected['nginx_mib']:.1f} MiB)"
+                )
+        if size_bytes > expected["bytes"] * SIZE_TOLERANCE:
+            failures.append(
+                f"{size} targets: config grew from {expected['bytes']} to {size_bytes} bytes"
+            )
+        if render_ms > expected["render_ms"] * TIME_TOLERANCE + TIME_SLACK_MS:
+            failures.append(
+                f"{size} targets: render took {render_ms:.1f} ms "
+                f"(baseline {expected['render_ms']:.1f} ms)"
+            )
+
+    if args.update:
+        baseline.update(measured)
+        generate._write_text(BASELINE_PATH, json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"updated golden files and baseline in {GOLDEN_DIR}")
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
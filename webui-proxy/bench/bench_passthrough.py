@@ -0,0 +1,190 @@
+"""Throughput of a large download through the rewrite and pass-through paths.
+
+A local stand-in device serves a multi-hundred-MB file over a link throttled
+to a typical device's uplink and gzips it when the client accepts it and it
+gets smaller, like most embedded web servers do for static files. Two
+payloads are measured:
+
+  log archive   a text log export, which compresses well.
+  firmware      random bytes, like an already-compressed backup or image;
+                gzip does not shrink it, so both paths send the same bytes.
+
+For each payload the file is downloaded the way each generated location
+handles it:
+
+  rewrite       Accept-Encoding is stripped, so the device sends the body
+                uncompressed. sub_filter and gzip skip the type, so nginx
+                copies the body as is.
+  passthrough   the client's Accept-Encoding reaches the device and the
+                compressed body is copied through untouched.
+
+With nginx installed, the requests go through nginx running the generated
+config: an extension-less path lands in the rewrite location and the .tar
+path in the pass-through one. Without nginx (or with --direct), the client
+sends the Accept-Encoding each location would forward straight to the device.
+
+Usage: python3 bench/bench_passthrough.py [--size-mb 256] [--link-mbit 100] [--direct]
+"""
+
+import argparse
+import gzip
+import http.client
+import http.server
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import common  # noqa: E402
+import generate  # noqa: E402
+
+SIZE_MB = 256
+LINK_MBIT = 100
+CHUNK = 256 * 1024
+CLIENT_ENCODING = "gzip, deflate"
+
+
+def _log_archive(size):
+    rng = random.Random(1)
+    lines = []
+    length = 0
+    while length < 1024 * 1024:
+        line = (
+            f"2024-05-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d} "
+            f"{rng.choice(['INFO', 'WARN', 'DEBUG'])} sensor.{rng.randint(1, 400)} "
+            f"value={rng.random():.4f} src=\"/api/states/{rng.randint(1, 99)}\"\n"
+        )
+        lines.append(line)
+        length += len(line)
+    block = "".join(lines).encode("utf-8")
+    return (block * (size // len(block) + 1))[:size]
+
+
+def _firmware(size):
+    return random.Random(1).randbytes(size)
+
+
+class _Device(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    plain = b""
+    compressed = None
+    link_bytes_per_second = LINK_MBIT * 125000
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.server.plain
+        encoded = (
+            self.server.compressed is not None
+            and "gzip" in self.headers.get("Accept-Encoding", "")
+        )
+        if encoded:
+            body = self.server.compressed
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-tar")
+        self.send_header("Content-Length", str(len(body)))
+        if encoded:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        view = memoryview(body)
+        started = time.perf_counter()
+        for offset in range(0, len(body), CHUNK):
+            self.wfile.write(view[offset : offset + CHUNK])
+            due = started + (offset + CHUNK) / self.server.link_bytes_per_second
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def log_message(self, *args):
+        pass
+
+
+def _download(port, path, accept_encoding):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    started = time.perf_counter()
+    connection.request(
+        "GET",
+        path,
+        headers={"Accept-Encoding": accept_encoding, "X-Ingress-Path": common.INGRESS_PATH},
+    )
+    response = connection.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"{path}: HTTP {response.status}")
+    wire = 0
+    while True:
+        chunk = response.read(CHUNK)
+        if not chunk:
+            break
+        wire += len(chunk)
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return wire, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=SIZE_MB, help="payload size")
+    parser.add_argument("--link-mbit", type=float, default=LINK_MBIT, help="device uplink")
+    parser.add_argument("--direct", action="store_true", help="skip nginx, hit the device")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    device = _Device(("127.0.0.1", 0), _Handler)
+    device.link_bytes_per_second = args.link_mbit * 125000
+    threading.Thread(target=device.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as root:
+        process = None
+        if not args.direct:
+            target = generate._parse_target(f"127.0.0.1:{device.server_address[1]}")
+            process, nginx_port = common._start_nginx(root, [target])
+            if process is None:
+                print("nginx not found, measuring the device directly")
+        if process is None:
+            port = device.server_address[1]
+            paths = (
+                ("rewrite", "/backup/logs", ""),
+                ("passthrough", "/backup/logs.tar", CLIENT_ENCODING),
+            )
+        else:
+            port = nginx_port
+            paths = (
+                ("rewrite", "/proxy/1/backup/logs", CLIENT_ENCODING),
+                ("passthrough", "/proxy/1/backup/logs.tar", CLIENT_ENCODING),
+            )
+
+        print(
+            f"mode {'nginx' if process else 'direct'}, payload {size / 1024 / 1024:.0f} MB, "
+            f"link {device.link_bytes_per_second / 125000:.0f} Mbit/s"
+        )
+        print(
+            f"{'payload':<12} {'path':<12} {'wire MB':>8} {'seconds':>8} "
+            f"{'MB/s':>8} {'speedup':>8}"
+        )
+        for name, build in (("log archive", _log_archive), ("firmware", _firmware)):
+            device.plain = build(size)
+            compressed = gzip.compress(device.plain, 6, mtime=0)
+            device.compressed = compressed if len(compressed) < size else None
+            baseline = None
+            for label, path, encoding in paths:
+                wire, elapsed = _download(port, path, encoding)
+                rate = size / elapsed / (1024 * 1024)
+                baseline = baseline or rate
+                print(
+                    f"{name:<12} {label:<12} {wire / 1024 / 1024:>8.1f} {elapsed:>8.2f} "
+                    f"{rate:>8.1f} {rate / baseline:>7.2f}x"
+                )
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+    device.shutdown()
+
+
+if __name__ == "__main__":
+    main()
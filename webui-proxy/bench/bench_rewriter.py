@@ -0,0 +1,197 @@
+"""Throughput and coverage of the python rewrite engine against sub_filter.
+
+Two measurements:
+
+  tokenizer     each sample is fed in 16 KB chunks (nginx's buffer size)
+                through the streaming tokenizer of rewriter.py and through
+                the sub_filter emulation of bench/common.py with the rule set
+                nginx uses for that type. "urls" counts rewritten URLs, so
+                the HTML row shows what sub_filter misses (srcset, meta
+                refresh, @import, module imports, tags with attributes).
+  pipeline      a stand-in device serves a gzip-compressed bundle with an
+                ETag, and rewriter.py runs on a local port in front of it:
+                cold requests decompress, rewrite and recompress; warm ones
+                revalidate the ETag and replay the cached output. The nginx
+                row emulates its path in-process: identity body, sub_filter,
+                gzip level 5.
+
+Absolute numbers are Python's; the nginx rows are emulations, so compare
+the python rows against each other and the ratios rather than nginx itself.
+
+Usage: python3 bench/bench_rewriter.py [bundle.js bundle.css page.html ...]
+"""
+
+import gzip
+import http.client
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import common  # noqa: E402
+import generate  # noqa: E402
+import rewriter  # noqa: E402
+
+TARGET = common.TARGET
+INGRESS = common.INGRESS_PATH
+BASE = f"{INGRESS}/proxy/1"
+CHUNK = 16 * 1024
+ROUNDS = 3
+REQUESTS = 20
+
+# The shared samples plus the constructs sub_filter cannot see: module
+# imports, @import, srcset, attributes with spaces and meta refresh.
+JS_TOKENS = common.JS_TOKENS + [
+    'import("/static/js/chunk.42.js").then(function(m){return m.default});',
+]
+CSS_TOKENS = common.CSS_TOKENS + ['@import "/static/css/theme.css";']
+HTML_TOKENS = common.HTML_TOKENS + [
+    '<img srcset="/img/logo.png 1x, /img/logo@2x.png 2x" alt="logo">',
+    '<a class="nav" href = "/settings">Settings</a>',
+    '<script type="module">import {h} from "/static/js/ui.js";</script>',
+]
+HTML_HEAD = '<html><head><meta http-equiv="refresh" content="600; url=/login">'
+
+
+def _sub_filter(kind):
+    return common._sub_filter(generate._rewrite_rules(TARGET, kind))
+
+
+def _python(kind):
+    context = rewriter._Context(TARGET, BASE, INGRESS)
+
+    def run(body):
+        if kind == "html":
+            stream = rewriter._HtmlRewriter(context)
+        else:
+            stream = rewriter._TextRewriter(context, kind)
+        out = []
+        for offset in range(0, len(body), CHUNK):
+            out.append(stream.feed(body[offset : offset + CHUNK].decode("utf-8")))
+        out.append(stream.feed("", True))
+        return "".join(out).encode("utf-8")
+
+    return run
+
+
+def _measure(run, body):
+    best = None
+    output = b""
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        output = run(body)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(body) / best / (1024 * 1024), output.count(f"{BASE}/".encode("utf-8"))
+
+
+class _Device(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    plain = b""
+    compressed = b""
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if '"bundle-1"' in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", '"bundle-1"')
+            self.end_headers()
+            return
+        encoded = "gzip" in self.headers.get("Accept-Encoding", "")
+        body = self.server.compressed if encoded else self.server.plain
+        self.send_response(200)
+        self.send_header("Content-Type", "application/javascript")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"bundle-1"')
+        if encoded:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _fetch(port, path, headers):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    started = time.perf_counter()
+    connection.request("GET", path, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    elapsed = time.perf_counter() - started
+    connection.close()
+    if response.status != 200:
+        raise RuntimeError(f"{path}: HTTP {response.status}")
+    return elapsed
+
+
+def _pipeline(body):
+    device = _Device(("127.0.0.1", 0), _Handler)
+    device.plain = body
+    device.compressed = gzip.compress(body, 6, mtime=0)
+    threading.Thread(target=device.serve_forever, daemon=True).start()
+
+    root = tempfile.mkdtemp()
+    generate.OPTIONS_PATH = os.path.join(root, "options.json")
+    generate.BACKUP_PATH = os.path.join(root, "backup.json")
+    generate.REWRITER_CACHE_PATH = os.path.join(root, "cache")
+    generate.REWRITER_PORT = common._free_port()
+    target = {"name": "bench", "url": f"127.0.0.1:{device.server_address[1]}", "engine": "python"}
+    generate._write_json(generate.OPTIONS_PATH, {"targets": [target]})
+    threading.Thread(target=rewriter.main, daemon=True).start()
+    common._wait_for_port(generate.REWRITER_PORT)
+
+    headers = {
+        "X-Webui-Proxy-Target": "1",
+        "X-Ingress-Path": INGRESS,
+        "X-Forwarded-Prefix": BASE,
+        "Accept-Encoding": "gzip",
+    }
+    # A fresh query string per cold request misses the cache; warm requests
+    # repeat the last one.
+    cold = [_fetch(generate.REWRITER_PORT, f"/app.js?v={idx}", headers) for idx in range(REQUESTS)]
+    warm = [_fetch(generate.REWRITER_PORT, f"/app.js?v={REQUESTS - 1}", headers) for _ in range(REQUESTS)]
+    device.shutdown()
+    shutil.rmtree(root, ignore_errors=True)
+
+    emulated = _sub_filter("js")
+    nginx = []
+    for _ in range(REQUESTS):
+        started = time.perf_counter()
+        gzip.compress(emulated(body), 5)
+        nginx.append(time.perf_counter() - started)
+    return {"nginx (emulated)": nginx, "python cold": cold, "python warm": warm}
+
+
+def main(argv):
+    print(f"{'sample':<16} {'engine':<8} {'MB/s':>8} {'urls':>7}")
+    bundle = None
+    samples = common._samples(argv, JS_TOKENS, CSS_TOKENS, HTML_TOKENS, HTML_HEAD)
+    for name, kind, body in samples:
+        for label, run in (("nginx", _sub_filter(kind)), ("python", _python(kind))):
+            rate, urls = _measure(run, body)
+            print(f"{name:<16} {label:<8} {rate:>8.1f} {urls:>7}")
+        if kind == "js" and bundle is None:
+            bundle = body
+    if bundle is None:
+        return
+    print()
+    print(f"bundle {len(bundle) / 1024 / 1024:.1f} MB, {REQUESTS} requests")
+    print(f"{'pipeline':<18} {'p50 ms':>8} {'MB/s':>8}")
+    for label, timings in _pipeline(bundle).items():
+        timings.sort()
+        median = timings[len(timings) // 2]
+        print(f"{label:<18} {median * 1000:>8.1f} {len(bundle) / median / (1024 * 1024):>8.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
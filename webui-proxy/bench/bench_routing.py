@@ -0,0 +1,95 @@
+"""Per-request cost of referer-based routing for 1 to 200 targets.
+
+Models the two map layouts nginx evaluates for root-relative requests such as
+/api/ or /fonts/: the old layout with one case-insensitive regex per target,
+evaluated in order and repeated for each mapped variable, and the current
+layout with a single capture regex followed by exact-match (hashed) lookups.
+
+Usage: python3 bench/bench_routing.py
+"""
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import generate  # noqa: E402
+
+SIZES = (1, 10, 50, 100, 200)
+REQUESTS = 2000
+INGRESS = "https://ha.local/api/hassio_ingress/0123456789abcdef"
+
+
+def _targets(count):
+    return [
+        generate._parse_target(f"192.168.{idx // 250}.{idx % 250 + 1}:8080")
+        for idx in range(count)
+    ]
+
+
+def _legacy_router(targets):
+    maps = []
+    for _ in ("proxy_target", "proxy_host"):
+        maps.append(
+            [
+                (re.compile(f"/proxy/{idx}/", re.IGNORECASE), target["host"])
+                for idx, target in enumerate(targets, start=1)
+            ]
+        )
+
+    def route(referer):
+        result = None
+        for entries in maps:
+            for pattern, value in entries:
+                if pattern.search(referer):
+                    result = value
+                    break
+        return result
+
+    return route
+
+
+def _indexed_router(targets):
+    extract = re.compile(r"/proxy/(\d+)/", re.IGNORECASE)
+    maps = [
+        {str(idx): target["host"] for idx, target in enumerate(targets, start=1)}
+        for _ in ("proxy_target", "proxy_host", "proxy_sni")
+    ]
+
+    def route(referer):
+        match = extract.search(referer)
+        index = match.group(1) if match else ""
+        result = None
+        for values in maps:
+            result = values.get(index)
+        return result
+
+    return route
+
+
+def main():
+    print(f"{'targets':>7} {'legacy ns/req':>14} {'indexed ns/req':>15} {'speedup':>8}")
+    rng = random.Random(1)
+    for size in SIZES:
+        targets = _targets(size)
+        referers = [
+            f"{INGRESS}/proxy/{rng.randint(1, size)}/index.html" for _ in range(REQUESTS)
+        ]
+        results = []
+        for factory in (_legacy_router, _indexed_router):
+            route = factory(targets)
+            elapsed = min(
+                timeit.repeat(
+                    lambda: [route(referer) for referer in referers], number=1, repeat=5
+                )
+            )
+            results.append(elapsed / REQUESTS * 1e9)
+        legacy, indexed = results
+        print(f"{size:>7} {legacy:>14.0f} {indexed:>15.0f} {legacy / indexed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
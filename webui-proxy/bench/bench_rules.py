@@ -0,0 +1,49 @@
+"""Compare sub_filter rule-set throughput: legacy full list vs per-type sets.
+
+nginx's sub_filter is emulated with a single-pass regex alternation over the
+literal search strings, which scales with the number of patterns the same way
+the real filter does. Absolute numbers differ from nginx; the ratios between
+rule sets are what this measures.
+
+Usage: python3 bench/bench_rules.py [bundle.js bundle.css page.html ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import common  # noqa: E402
+import generate  # noqa: E402
+
+TARGET = common.TARGET
+ROUNDS = 5
+
+
+def _throughput(rules, body):
+    run = common._sub_filter(rules)
+    best = None
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        run(body)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(body) / best / (1024 * 1024)
+
+
+def main(argv):
+    minimal = dict(TARGET, rules="core")
+    print(f"{'sample':<16} {'rule set':<18} {'rules':>5} {'MB/s':>8} {'speedup':>8}")
+    for name, kind, body in common._samples(argv):
+        legacy = generate._rewrite_rules(TARGET)
+        baseline = _throughput(legacy, body)
+        print(f"{name:<16} {'legacy (all)':<18} {len(legacy):>5} {baseline:>8.1f} {1:>7.2f}x")
+        for label, target in ((f"{kind} (all packs)", TARGET), (f"{kind} (core)", minimal)):
+            rules = generate._rewrite_rules(target, kind)
+            rate = _throughput(rules, body)
+            print(f"{name:<16} {label:<18} {len(rules):>5} {rate:>8.1f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+"""Time from start to rendered config when targets are restored from backup.
+
+Runs the one-shot render against a temporary directory and a local stand-in
+Supervisor API that answers POST /addons/self/options after a configurable
+delay. Compares the old order (sync the options, then render) with the
+current one (render, then sync in the background) and reports when the
+Supervisor actually received the options.
+
+Usage: python3 bench/bench_startup.py [delay_seconds ...]
+"""
+
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import generate  # noqa: E402
+
+DELAYS = (0.0, 0.5, 2.0)
+TARGETS = [
+    {"name": f"Device {idx}", "url": f"192.168.1.{idx}:8080"} for idx in range(1, 21)
+]
+
+
+class _Supervisor(http.server.ThreadingHTTPServer):
+    delay = 0.0
+    received = None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+        self.server.received = time.monotonic()
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _prepare(root):
+    for name in ("data", "share", "html", "shm"):
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+    generate.OPTIONS_PATH = os.path.join(root, "data", "options.json")
+    generate.BACKUP_PATH = os.path.join(root, "share", "webui-proxy.json")
+    generate.NGINX_CONF_PATH = os.path.join(root, "nginx.conf")
+    generate.SNIPPET_DIR = os.path.join(root, "snippets")
+    generate.HTML_PATH = os.path.join(root, "html", "index.html")
+    generate.STATUS_PATH = os.path.join(root, "shm", "status.json")
+    generate.ACCESS_LOG_PATH = os.path.join(root, "shm", "access.log")
+    with open(generate.OPTIONS_PATH, "w", encoding="utf-8") as handle:
+        json.dump({"targets": []}, handle)
+    with open(generate.BACKUP_PATH, "w", encoding="utf-8") as handle:
+        json.dump({"targets": TARGETS}, handle)
+    for name in ("nginx.conf", os.path.join("html", "index.html")):
+        path = os.path.join(root, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _blocking():
+    targets, restored = generate._load_targets()
+    settings = generate._load_settings()
+    if restored:
+        generate._update_supervisor_options(targets)
+    generate._write_outputs(targets, settings)
+
+
+def _background(threads):
+    def spawn():
+        targets, _ = generate._load_targets()
+        thread = threading.Thread(target=generate._sync_supervisor_options, args=(targets,))
+        thread.start()
+        threads.append(thread)
+
+    generate._spawn_supervisor_sync = spawn
+    generate.main([])
+
+
+def main():
+    delays = [float(value) for value in sys.argv[1:]] or DELAYS
+    server = _Supervisor(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["SUPERVISOR_TOKEN"] = "bench"
+    os.environ["SUPERVISOR_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    generate._log = lambda message: None
+
+    print(f"{'delay s':>7} {'mode':>10} {'rendered ms':>12} {'synced ms':>10}")
+    with tempfile.TemporaryDirectory() as root:
+        for delay in delays:
+            server.delay = delay
+            for mode in ("blocking", "background"):
+                _prepare(root)
+                server.received = None
+                threads = []
+                started = time.monotonic()
+                if mode == "blocking":
+                    _blocking()
+                else:
+                    _background(threads)
+                rendered = time.monotonic() - started
+                for thread in threads:
+                    thread.join()
+                synced = (server.received or started) - started
+                print(
+                    f"{delay:>7.1f} {mode:>10} {rendered * 1000:>12.1f} {synced * 1000:>10.1f}"
+                )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Fixtures shared by the bench scripts.
+
+Synthetic JS, CSS and HTML samples, the sub_filter emulation (a single-pass
+regex alternation over the literal search strings, which scales with the
+number of patterns the same way the real filter does) and helpers to run the
+generated config under a local nginx.
+"""
+
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import generate  # noqa: E402
+
+TARGET = generate._parse_target({"name": "bench", "url": "https://192.168.1.30:8006"})
+INGRESS_PATH = "/api/hassio_ingress/0123456789abcdef"
+# Values nginx substitutes for the variables in the rules at request time.
+VARIABLES = {
+    "$http_x_ingress_path": INGRESS_PATH,
+    "$proxy_index": "1",
+    "$proxy_host": "192.168.1.30:8006",
+    "$proxy_sni": "192.168.1.30",
+}
+SAMPLE_SIZE = 2 * 1024 * 1024
+
+JS_TOKENS = [
+    "function(e,t,n){var r=n(42);",
+    'e.exports={render:function(){return h("div",{class:"row"})}};',
+    'fetch("/api/nodes/"+t).then(function(r){return r.json()});',
+    "var o=document.createElement('script');o.src=a.p+c;",
+    'n.p="/";',
+    "for(var i=0;i<t.length;i++){s+=t[i].toString(16)}",
+    'throw new Error("Unexpected token "+JSON.stringify(e));',
+]
+CSS_TOKENS = [
+    ".btn{display:inline-block;padding:6px 12px;margin-bottom:0}",
+    '@font-face{font-family:"Glyphicons";src:url(glyphicons-halflings.woff2)}',
+    ".icon{background:url(/images/sprite.png) no-repeat}",
+    "@media (max-width:768px){.navbar{float:none;width:100%}}",
+]
+HTML_TOKENS = [
+    '<div class="panel"><a href="/dashboard">Dashboard</a></div>',
+    '<script src="/static/js/app.js"></script>',
+    "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>",
+    '<link rel="stylesheet" href="/static/css/app.css">',
+]
+HTML_HEAD = "<html><head>"
+
+
+def _synthetic(tokens, head=""):
+    rng = random.Random(1)
+    parts = [head]
+    size = len(head)
+    while size < SAMPLE_SIZE:
+        token = rng.choice(tokens)
+        parts.append(token)
+        size += len(token)
+    return "".join(parts).encode("utf-8")
+
+
+def _samples(paths, js=JS_TOKENS, css=CSS_TOKENS, html=HTML_TOKENS, head=HTML_HEAD):
+    if paths:
+        samples = []
+        for path in paths:
+            kind = os.path.splitext(path)[1].lstrip(".")
+            kind = {"mjs": "js", "htm": "html"}.get(kind, kind)
+            with open(path, "rb") as file:
+                samples.append((os.path.basename(path), kind, file.read()))
+        return samples
+    return [
+        ("synthetic.js", "js", _synthetic(js)),
+        ("synthetic.css", "css", _synthetic(css)),
+        ("synthetic.html", "html", _synthetic(html, head)),
+    ]
+
+
+def _expand(value):
+    for variable, replacement in VARIABLES.items():
+        value = value.replace(variable, replacement)
+    return value
+
+
+def _sub_filter(rules):
+    rules = [(_expand(search), _expand(replace)) for search, replace in rules]
+    lookup = {search.encode("utf-8"): replace.encode("utf-8") for search, replace in rules}
+    pattern = re.compile(b"|".join(re.escape(search) for search in lookup))
+
+    def run(body):
+        # nginx matches across buffer boundaries, so whole-body substitution
+        # gives the same output.
+        return pattern.sub(lambda match: lookup[match.group(0)], body)
+
+    return run
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def _start_nginx(root, targets, overrides=None):
+    # Renders the config for the targets into a temporary prefix and starts
+    # nginx in the foreground; (None, None) when nginx is not installed.
+    nginx = shutil.which("nginx")
+    if not nginx:
+        return None, None
+    generate.NGINX_PID_PATH = os.path.join(root, "nginx.pid")
+    generate.ERROR_LOG_PATH = os.path.join(root, "error.log")
+    generate.HTML_PATH = os.path.join(root, "html", "index.html")
+    generate.SNIPPET_DIR = os.path.join(root, "snippets")
+    generate.CACHE_PATH = os.path.join(root, "cache")
+    generate.STATUS_PATH = os.path.join(root, "status.json")
+    generate.ACCESS_LOG_PATH = os.path.join(root, "access.log")
+    generate.LISTEN_PORT = _free_port()
+    generate.REWRITE_PORT = _free_port()
+    settings = dict(generate.DEFAULT_SETTINGS, metrics=False, **(overrides or {}))
+    snippets = {}
+    conf = generate._render_nginx_conf(targets, settings, (), snippets)
+    os.makedirs(os.path.dirname(generate.HTML_PATH), exist_ok=True)
+    for name, content in snippets.items():
+        generate._write_text(os.path.join(generate.SNIPPET_DIR, name), content)
+    conf_path = os.path.join(root, "nginx.conf")
+    generate._write_text(conf_path, conf)
+    process = subprocess.Popen(
+        [nginx, "-p", root, "-c", conf_path, "-g", "daemon off;"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if not _wait_for_port(generate.LISTEN_PORT):
+        process.kill()
+        raise RuntimeError(f"nginx did not start: {process.stderr.read().decode(errors='ignore')}")
+    return process, generate.LISTEN_PORT
@@ -0,0 +1,240 @@
+"""Replay a recorded page load through the generated nginx config.
+
+A local stand-in device serves every resource of the recording (a HAR file
+exported from the browser's network tab, or a built-in synthetic SPA page
+load). nginx is started on a temporary prefix with the config generate.py
+renders for that device, and a number of virtual users replay the page load
+through it the way a browser behind the Supervisor would: the document first,
+then the remaining resources over a pool of persistent connections.
+
+Reports request latency percentiles, throughput and how many TCP connections
+the client had to open. Listener settings can be overridden to compare them:
+
+  python3 bench/loadtest.py --set keepalive_requests=100 --set keepalive_timeout=5
+
+Without nginx installed (or with --direct), the users hit the stand-in device
+directly, which gives the baseline without the proxy.
+
+Usage: python3 bench/loadtest.py [--har page.har] [--users 8] [--pages 10]
+                                 [--connections 6] [--direct] [--set key=value ...]
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import common  # noqa: E402
+import generate  # noqa: E402
+
+INGRESS_PATH = common.INGRESS_PATH
+# A typical device SPA: document, bundles, styles, icons and the first API
+# calls, with sizes in bytes.
+SYNTHETIC_PAGE = (
+    [("/", "text/html", 6 * 1024)]
+    + [(f"/static/js/chunk.{idx}.js", "application/javascript", 40 * 1024) for idx in range(16)]
+    + [(f"/static/css/app.{idx}.css", "text/css", 12 * 1024) for idx in range(4)]
+    + [(f"/static/img/icon-{idx}.png", "image/png", 3 * 1024) for idx in range(24)]
+    + [(f"/api/state/{idx}", "application/json", 2 * 1024) for idx in range(10)]
+)
+
+
+def _recording(path):
+    if not path:
+        return list(SYNTHETIC_PAGE)
+    with open(path, "r", encoding="utf-8") as file:
+        har = json.load(file)
+    resources = []
+    seen = set()
+    for entry in har["log"]["entries"]:
+        if entry["request"].get("method", "GET") != "GET":
+            continue
+        url = urllib.parse.urlsplit(entry["request"]["url"])
+        target = url.path + (f"?{url.query}" if url.query else "")
+        if target in seen:
+            continue
+        seen.add(target)
+        content = entry["response"].get("content", {})
+        size = max(content.get("size") or 0, entry["response"].get("bodySize") or 0, 0)
+        resources.append((target, content.get("mimeType") or "application/octet-stream", size))
+    return resources
+
+
+class _Device(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+    resources = {}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        resource = self.server.resources.get(self.path)
+        if resource is None:
+            self.send_error(404)
+            return
+        content_type, body = resource
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _body(content_type, size):
+    if content_type.startswith("text/html"):
+        head = b'<html><head><script src="/static/js/app.js"></script>'
+        return head + b"x" * max(0, size - len(head))
+    if content_type.startswith(("application/javascript", "text/css")):
+        line = b'fetch("/api/state");url(/static/img/a.png);\n'
+        return (line * (size // len(line) + 1))[:size]
+    return b"\0" * size
+
+
+class _Client:
+    def __init__(self, port, stats):
+        self.port = port
+        self.stats = stats
+        self.connection = None
+
+    def get(self, path, headers):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            with self.stats["lock"]:
+                self.stats["connections"] += 1
+        started = time.perf_counter()
+        try:
+            self.connection.request("GET", path, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            ok = response.status < 400
+            if response.will_close:
+                self.close()
+        except (OSError, http.client.HTTPException):
+            ok = False
+            self.close()
+        elapsed = time.perf_counter() - started
+        with self.stats["lock"]:
+            self.stats["latencies"].append(elapsed)
+            if not ok:
+                self.stats["errors"] += 1
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def _user(port, prefix, resources, pages, connections, stats):
+    headers = {"X-Ingress-Path": INGRESS_PATH, "Accept-Encoding": "gzip"}
+    clients = [_Client(port, stats) for _ in range(connections)]
+    document, rest = resources[0], resources[1:]
+    for _ in range(pages):
+        clients[0].get(prefix + document[0], headers)
+        queue = list(rest)
+        lock = threading.Lock()
+
+        def worker(client):
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    path = queue.pop(0)[0]
+                client.get(prefix + path, dict(headers, Referer=f"{INGRESS_PATH}{prefix}/"))
+
+        threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for client in clients:
+        client.close()
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _setting(item):
+    key, _, value = item.partition("=")
+    if key not in generate.DEFAULT_SETTINGS:
+        raise argparse.ArgumentTypeError(f"unknown setting {key}")
+    default = generate.DEFAULT_SETTINGS[key]
+    if isinstance(default, bool):
+        return key, value.lower() in ("1", "true", "yes", "on")
+    return key, generate._coerce_setting(value, default)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--har", help="HAR file with the page load to replay")
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--pages", type=int, default=10, help="page loads per user")
+    parser.add_argument("--connections", type=int, default=6, help="connections per user")
+    parser.add_argument("--direct", action="store_true", help="skip nginx, hit the device")
+    parser.add_argument("--set", type=_setting, action="append", default=[], metavar="KEY=VALUE")
+    args = parser.parse_args()
+
+    resources = _recording(args.har)
+    device = _Device(("127.0.0.1", 0), _Handler)
+    device.resources = {
+        path: (content_type, _body(content_type, size)) for path, content_type, size in resources
+    }
+    threading.Thread(target=device.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as root:
+        process, port, prefix = None, device.server_address[1], ""
+        if not args.direct:
+            target = generate._parse_target(f"127.0.0.1:{device.server_address[1]}")
+            process, nginx_port = common._start_nginx(root, [target], dict(args.set))
+            if process is None:
+                print("nginx not found, measuring the device directly")
+            else:
+                port, prefix = nginx_port, "/proxy/1"
+        stats = {"latencies": [], "errors": 0, "connections": 0, "lock": threading.Lock()}
+        started = time.perf_counter()
+        users = [
+            threading.Thread(
+                target=_user,
+                args=(port, prefix, resources, args.pages, args.connections, stats),
+            )
+            for _ in range(args.users)
+        ]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - started
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+    device.shutdown()
+
+    latencies = stats["latencies"]
+    print(f"mode         {'nginx' if prefix else 'direct'}")
+    print(f"resources    {len(resources)} per page, {args.users} users x {args.pages} pages")
+    print(f"requests     {len(latencies)} ({stats['errors']} errors)")
+    print(f"connections  {stats['connections']}")
+    print(f"throughput   {len(latencies) / elapsed:.0f} req/s")
+    print(f"p50          {_percentile(latencies, 0.50) * 1000:.2f} ms")
+    print(f"p99          {_percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"max          {max(latencies) * 1000:.2f} ms")
+    return 1 if stats["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
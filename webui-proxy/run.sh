@@ -3,4 +3,9 @@ set -euo pipefail
 
 python3 /app/generate.py
 
+python3 /app/generate.py --watch &
+python3 /app/healthcheck.py &
+python3 /app/metrics.py &
+python3 /app/rewriter.py &
+
 exec nginx -g 'daemon off;'